@@ -10,22 +10,474 @@
 #
 #
 
-import subprocess, sys, re, os.path, optparse, collections
+import sys, os.path, optparse, collections, struct, mmap, contextlib, threading, Queue, sqlite3, json
 from pprint import pprint
 
 
+# The parts of a Mach-O image that the dependency analysis needs, for one architecture
+class MachOLoadInfo:
+
+    def __init__(self, arch, header_info, install_name = None, rpaths = None, dependencies = None):
+        self.arch = arch
+        self.header_info = header_info
+        self.install_name = install_name
+        self.rpaths = rpaths or []
+        # (load command name, recorded path) tuples in load command order
+        self.dependencies = dependencies or []
+
+
+# Reads Mach-O headers and load commands directly from the mapped file, for thin
+# and fat (universal) binaries. This replaces one otool process per image and
+# query and works on any platform.
+class MachOReader:
+
+    def __init__(self, path):
+        self.path = path
+
+    # Maps the file instead of reading it, only the pages holding the headers are ever touched
+    @contextlib.contextmanager
+    def mapped_data(self):
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < 8:
+                yield ''
+                return
+            mapping = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            try:
+                yield mapping
+            finally:
+                mapping.close()
+
+    def slices(self, data):
+        # Returns (arch, offset, size) tuples
+        if len(data) < 8:
+            return []
+        magic = struct.unpack_from('>I', data, 0)[0]
+        if magic in (MachOReader.FAT_MAGIC, MachOReader.FAT_MAGIC_64):
+            # Fat headers are always big-endian
+            slices = []
+            arch_count = struct.unpack_from('>I', data, 4)[0]
+            offset = 8
+            for i in range(arch_count):
+                if magic == MachOReader.FAT_MAGIC_64:
+                    cputype, cpusubtype, slice_offset, slice_size = struct.unpack_from('>iiQQ', data, offset)
+                    offset += 32
+                else:
+                    cputype, cpusubtype, slice_offset, slice_size = struct.unpack_from('>iiII', data, offset)
+                    offset += 20
+                slices.append((MachOReader.arch_name(cputype, cpusubtype), slice_offset, slice_size))
+            return slices
+
+        endian = MachOReader.endian_for_magic(data, 0)
+        if not endian:
+            return []
+        cputype, cpusubtype = struct.unpack_from(endian + 'ii', data, 4)
+        return [(MachOReader.arch_name(cputype, cpusubtype), 0, len(data))]
+
+    def architectures(self):
+        with self.mapped_data() as data:
+            return [arch for arch, offset, size in self.slices(data)]
+
+    def load_info(self, arch):
+        return self.load_infos([arch]).get(arch)
+
+    def load_infos(self, archs):
+        # Parses the slices for several architectures from a single mapping of the
+        # file. None picks the first slice. Architectures the file lacks are left out.
+        infos = {}
+        with self.mapped_data() as data:
+            try:
+                slices = self.slices(data)
+                for arch in archs:
+                    for slice_arch, offset, size in slices:
+                        if slice_arch == arch or arch is None:
+                            infos[arch] = self.load_info_for_slice(data, slice_arch, offset)
+                            break
+            except struct.error:
+                # Truncated or corrupt file
+                pass
+        return infos
+
+    def preferred_architectures(self):
+        # All architectures of the file, the ones most likely to be of interest first
+        archs = self.architectures()
+        preferred = [arch for arch in MachOReader.PREFERRED_ARCHS if arch in archs]
+        return preferred + [arch for arch in archs if arch not in preferred]
+
+    def load_info_for_slice(self, data, arch, offset):
+        endian = MachOReader.endian_for_magic(data, offset)
+        if not endian:
+            return None
+        magic, cputype, cpusubtype, filetype, ncmds, sizeofcmds, flags = struct.unpack_from(endian + 'IiiIIII', data, offset)
+        header_info = dict(magic = magic, cputype = cputype, cpusubtype = cpusubtype & ~MachOReader.CPU_SUBTYPE_MASK,
+            caps = (cpusubtype & MachOReader.CPU_SUBTYPE_MASK) >> 24, filetype = filetype, ncmds = ncmds, sizeofcmds = sizeofcmds, flags = flags)
+        info = MachOLoadInfo(arch, header_info)
+
+        command_offset = offset + (32 if magic == MachOReader.MH_MAGIC_64 else 28)
+        for i in range(ncmds):
+            cmd, cmdsize = struct.unpack_from(endian + 'II', data, command_offset)
+            if cmdsize < 8:
+                break
+            command_name = MachOReader.DYLIB_COMMANDS.get(cmd)
+            if command_name or cmd == MachOReader.LC_RPATH:
+                # Both dylib_command and rpath_command start with the offset of their string
+                string_offset = struct.unpack_from(endian + 'I', data, command_offset + 8)[0]
+                string = data[command_offset + string_offset:command_offset + cmdsize].split('\0', 1)[0]
+                if cmd == MachOReader.LC_RPATH:
+                    info.rpaths.append(string)
+                elif cmd == MachOReader.LC_ID_DYLIB:
+                    info.install_name = string
+                else:
+                    info.dependencies.append((command_name, string))
+            command_offset += cmdsize
+
+        return info
+
+    @staticmethod
+    def is_macho_file(path):
+        with open(path, 'rb') as f:
+            header = f.read(8)
+        if len(header) < 8:
+            return False
+        magic, arch_count = struct.unpack('>II', header)
+        if magic in (MachOReader.FAT_MAGIC, MachOReader.FAT_MAGIC_64):
+            # Java class files share the fat magic, their next field is a version number, not a small count
+            return 0 < arch_count < 32
+        return struct.unpack('<I', header[:4])[0] in (MachOReader.MH_MAGIC, MachOReader.MH_MAGIC_64, MachOReader.MH_CIGAM, MachOReader.MH_CIGAM_64)
+
+    @staticmethod
+    def find_macho_files(path):
+        # Identifies Mach-O files by their magic bytes, symlinks are skipped so that
+        # framework version links don't produce duplicates
+        if not os.path.isdir(path):
+            return [path]
+        paths = []
+        for directory, directory_names, file_names in os.walk(path):
+            directory_names.sort()
+            for file_name in sorted(file_names):
+                file_path = os.path.join(directory, file_name)
+                if os.path.islink(file_path) or not os.path.isfile(file_path):
+                    continue
+                if MachOReader.is_macho_file(file_path):
+                    paths.append(file_path)
+        return paths
+
+    @staticmethod
+    def endian_for_magic(data, offset):
+        if len(data) < offset + 28:
+            return None
+        magic = struct.unpack_from('<I', data, offset)[0]
+        if magic in (MachOReader.MH_MAGIC, MachOReader.MH_MAGIC_64):
+            return '<'
+        if magic in (MachOReader.MH_CIGAM, MachOReader.MH_CIGAM_64):
+            return '>'
+        return None
+
+    @staticmethod
+    def arch_name(cputype, cpusubtype):
+        cpusubtype &= ~MachOReader.CPU_SUBTYPE_MASK
+        name = MachOReader.ARCH_NAMES.get((cputype, cpusubtype)) or MachOReader.ARCH_NAMES.get((cputype, None))
+        return name or 'cputype{0}_{1}'.format(cputype, cpusubtype)
+
+    FAT_MAGIC = 0xcafebabe
+    FAT_MAGIC_64 = 0xcafebabf
+    MH_MAGIC = 0xfeedface
+    MH_CIGAM = 0xcefaedfe
+    MH_MAGIC_64 = 0xfeedfacf
+    MH_CIGAM_64 = 0xcffaedfe
+    CPU_SUBTYPE_MASK = 0xff000000
+    PREFERRED_ARCHS = ['x86_64', 'x86_64h', 'i386', 'arm64e', 'arm64']
+
+    LC_REQ_DYLD = 0x80000000
+    LC_LOAD_DYLIB = 0xc
+    LC_ID_DYLIB = 0xd
+    LC_LOAD_WEAK_DYLIB = 0x18 | LC_REQ_DYLD
+    LC_RPATH = 0x1c | LC_REQ_DYLD
+    LC_REEXPORT_DYLIB = 0x1f | LC_REQ_DYLD
+    LC_LAZY_LOAD_DYLIB = 0x20
+    LC_LOAD_UPWARD_DYLIB = 0x23 | LC_REQ_DYLD
+
+    DYLIB_COMMANDS = {
+        LC_LOAD_DYLIB: 'LC_LOAD_DYLIB',
+        LC_ID_DYLIB: 'LC_ID_DYLIB',
+        LC_LOAD_WEAK_DYLIB: 'LC_LOAD_WEAK_DYLIB',
+        LC_REEXPORT_DYLIB: 'LC_REEXPORT_DYLIB',
+        LC_LAZY_LOAD_DYLIB: 'LC_LAZY_LOAD_DYLIB',
+        LC_LOAD_UPWARD_DYLIB: 'LC_LOAD_UPWARD_DYLIB',
+    }
+
+    # (cputype, cpusubtype) to the names otool and lipo use, None matches any subtype
+    ARCH_NAMES = {
+        (7, 3): 'i386',
+        (7, None): 'i386',
+        (0x01000007, 3): 'x86_64',
+        (0x01000007, 8): 'x86_64h',
+        (0x01000007, None): 'x86_64',
+        (12, 6): 'armv6',
+        (12, 9): 'armv7',
+        (12, 11): 'armv7s',
+        (12, 12): 'armv7k',
+        (12, None): 'arm',
+        (0x0100000c, 0): 'arm64',
+        (0x0100000c, 2): 'arm64e',
+        (0x0100000c, None): 'arm64',
+        (0x0200000c, None): 'arm64_32',
+        (18, None): 'ppc',
+        (0x01000012, None): 'ppc64',
+    }
+
+
+# Persistent cache of parsed load commands, so repeated runs only parse images that
+# changed since they were last seen. Entries are keyed by the real path and the
+# architecture and are only used if inode, size and modification time still match.
+class ImageInfoCache:
+
+    def __init__(self, path = None):
+        self.path = os.path.abspath(path or ImageInfoCache.default_path())
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread = False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS images (path TEXT, arch TEXT, inode INTEGER, size INTEGER, mtime REAL, info TEXT, PRIMARY KEY (path, arch))')
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def default_path():
+        caches_path = os.path.expanduser('~/Library/Caches')
+        if not os.path.isdir(caches_path):
+            caches_path = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+        return os.path.join(caches_path, 'checklibs', 'images.sqlite')
+
+    @staticmethod
+    def key_for_path(path, arch):
+        real_path = os.path.realpath(path)
+        stat = os.stat(real_path)
+        return real_path, arch or '', stat.st_ino, stat.st_size, stat.st_mtime
+
+    def get(self, path, arch):
+        real_path, arch, inode, size, mtime = ImageInfoCache.key_for_path(path, arch)
+        with self.lock:
+            row = self.connection.execute('SELECT info FROM images WHERE path = ? AND arch = ? AND inode = ? AND size = ? AND mtime = ?', (real_path, arch, inode, size, mtime)).fetchone()
+            if not row:
+                self.misses += 1
+                return None
+            self.hits += 1
+        data = json.loads(row[0])
+        dependencies = [(command_name, str(recorded_path)) for command_name, recorded_path in data['dependencies']]
+        install_name = str(data['install_name']) if data['install_name'] else None
+        return MachOLoadInfo(str(data['arch']), data['header_info'], install_name, [str(rpath) for rpath in data['rpaths']], dependencies)
+
+    def put(self, path, arch, info):
+        key = ImageInfoCache.key_for_path(path, arch)
+        data = json.dumps(dict(arch = info.arch, header_info = info.header_info, install_name = info.install_name, rpaths = info.rpaths, dependencies = info.dependencies))
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)', key + (data,))
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+# Parses images on a pool of worker threads ahead of the dependency walk. The walk
+# itself stays sequential and depth-first, so the graph and its ordering are the
+# same as without the pool, but by the time it reaches an image that image has
+# usually been read already. Prefetching is breadth-first: as soon as an image
+# is parsed, its dependencies that can be resolved without knowing the loading
+# chain (absolute and @loader_path paths) are queued as well.
+# The loader reads all requested architectures of an image at once, so sessions
+# for different architectures can share one loader and each file is read once.
+class ImageInfoLoader:
+
+    def __init__(self, archs, jobs = 1, persistent_cache = None):
+        self.archs = archs
+        self.jobs = jobs
+        self.persistent_cache = persistent_cache
+        self.lock = threading.Lock()
+        self.results = {}
+        self.started = set()
+        self.done_events = {}
+        self.queue = Queue.Queue()
+        self.workers = []
+
+    def start_workers(self):
+        for i in range(self.jobs):
+            worker = threading.Thread(target = self.run_worker)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def run_worker(self):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                break
+            with self.lock:
+                if path in self.started:
+                    continue
+                self.started.add(path)
+            self.load(path)
+
+    def shutdown(self):
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def prefetch(self, path):
+        if self.jobs < 2 or not path:
+            return
+        with self.lock:
+            if path in self.done_events:
+                return
+            self.done_events[path] = threading.Event()
+            if not self.workers:
+                self.start_workers()
+        self.queue.put(path)
+
+    def load_info(self, path, arch):
+        with self.lock:
+            if path in self.results:
+                return self.results[path].get(arch)
+            if path not in self.done_events:
+                self.done_events[path] = threading.Event()
+            event = self.done_events[path]
+            # Not picked up by a worker yet, don't wait for the queue to drain
+            load_here = path not in self.started
+            self.started.add(path)
+        if load_here:
+            self.load(path)
+        else:
+            event.wait()
+        return self.results[path].get(arch)
+
+    def load(self, path):
+        infos = {}
+        try:
+            if os.path.exists(path):
+                infos = self.load_infos(path)
+        finally:
+            with self.lock:
+                self.results[path] = infos
+                event = self.done_events[path]
+            event.set()
+
+        loader_directory = os.path.dirname(path)
+        for info in infos.values():
+            if not info:
+                continue
+            for command_name, recorded_path in info.dependencies:
+                if recorded_path.startswith('/'):
+                    self.prefetch(recorded_path)
+                elif recorded_path.startswith(ImagePath.LOADER_PATH_TOKEN):
+                    self.prefetch(os.path.normpath(recorded_path.replace(ImagePath.LOADER_PATH_TOKEN, loader_directory)))
+
+    def load_infos(self, path):
+        infos = {}
+        if self.persistent_cache:
+            for arch in self.archs:
+                info = self.persistent_cache.get(path, arch)
+                if info:
+                    infos[arch] = info
+        missing_archs = [arch for arch in self.archs if arch not in infos]
+        if missing_archs:
+            for arch, info in MachOReader(path).load_infos(missing_archs).items():
+                infos[arch] = info
+                if info and self.persistent_cache:
+                    self.persistent_cache.put(path, arch, info)
+        return infos
+
+
+# The state of one dependency analysis: every image reached so far, in the order
+# it was first reached, the set of images already walked and the loader that reads
+# them. Toplevel images analyzed in the same session share one graph. Nothing is
+# shared between sessions (except an optional persistent cache, which is thread
+# safe), so independent analyses can run side by side in one process. Sessions for
+# several architectures of the same images can pass in one shared loader.
+class AnalysisSession:
+
+    def __init__(self, arch, jobs = 1, persistent_cache = None, verbose = False, loader = None, verbose_output = None):
+        self.arch = arch
+        self.verbose = verbose
+        # Where the verbose resolution trace goes, stdout unless that carries an exported graph
+        self.verbose_output = verbose_output or sys.stdout
+        self.owns_loader = loader is None
+        self.loader = loader or ImageInfoLoader([arch], jobs, persistent_cache)
+        self.images_by_path = {}
+        self.order = []
+        self.walked_paths = set()
+        # Resolving @rpath probes the same candidate paths over and over across a big graph
+        self.existing_paths = {}
+        self.probe_count = 0
+        self.stat_count = 0
+
+    def path_exists(self, path):
+        if not path:
+            return False
+        self.probe_count += 1
+        exists = self.existing_paths.get(path)
+        if exists is None:
+            self.stat_count += 1
+            exists = self.existing_paths[path] = os.path.exists(path)
+        return exists
+
+    def add_image(self, image):
+        self.images_by_path[image.image_path.resolved_path] = image
+        self.order.append(image)
+
+    def image_for_path(self, path):
+        if not path:
+            return None
+        return self.images_by_path.get(path)
+
+    def toplevel_image(self, path):
+        # Returns the image for the given path and walks its dependencies. It may have
+        # been reached already through another toplevel image of this session.
+        image = self.image_for_path(path)
+        if not image:
+            image_path = ImagePath(path)
+            image_path.path_exists = self.path_exists
+            image = MachOFile(image_path, self)
+        self.walk(image)
+        return image
+
+    def walk(self, image):
+        # Depth-first, in the same order as a recursive walk, but without the recursion limit
+        stack = [image]
+        while stack:
+            image = stack.pop()
+            if image.image_path.resolved_path in self.walked_paths:
+                continue
+            self.walked_paths.add(image.image_path.resolved_path)
+            stack.extend(reversed(image.dependencies()))
+
+    def close(self):
+        if self.owns_loader:
+            self.loader.shutdown()
+
+
+# Raised when a toplevel image has no usable Mach-O header for the analyzed architecture
+class MachOHeaderError(Exception):
+    pass
+
+
 class MachOFile:
 
-    def __init__(self, image_path, arch, parent = None, verbose = False):
+    def __init__(self, image_path, session, parent = None):
         self.image_path = image_path
+        self.session = session
         self._dependencies = []
-        self._cache = dict(paths = {}, order = [])
-        self.arch = arch
+        self.arch = session.arch
         self.parent = parent
-        self.verbose = verbose
+        self.verbose = session.verbose
         self.header_info = {}
+        self._rpaths = []
+        self._effective_rpaths = None
+        self.load_info_for_arch = None
         self.load_info()
-        self.add_to_cache()
+        self.session.add_image(self)
         
     def load_info(self):
         if not self.image_path.exists():
@@ -35,31 +487,28 @@ class MachOFile:
 
     def load_header(self):
         # Get the mach-o header info, we're interested in the file type (executable, dylib)
-        cmd = 'otool -arch {0} -h "{1}"'
-        output = self.shell(cmd, [self.arch, self.image_path.resolved_path], fatal = True)
-        if not output:
-            print >> sys.stderr, 'Unable to load mach header for {0} ({1}), architecture mismatch? Use --arch option to pick architecture'.format(self.image_path.resolved_path, self.arch)
-            exit()
-        # Take the last two lines from the output
-        (keys, values) = output.splitlines()[-2:]
-        self.header_info = dict(zip(keys.split(), values.split()))
+        self.load_info_for_arch = self.session.loader.load_info(self.image_path.resolved_path, self.arch)
+        if not self.load_info_for_arch:
+            message = 'Unable to load mach header for {0} ({1}), architecture mismatch? Use --arch option to pick architecture'.format(self.image_path.resolved_path, self.arch)
+            if not self.parent:
+                raise MachOHeaderError(message)
+            print >> sys.stderr, message
+            # Keep going for dependencies, the image is treated as having no load commands
+            self.load_info_for_arch = MachOLoadInfo(self.arch, {})
+        self.header_info = self.load_info_for_arch.header_info
         
     def load_rpaths(self):
-        output = self.shell('otool -arch {0} -l "{1}"', [self.arch, self.image_path.resolved_path], fatal = True)
-        load_commands = re.split('Load command (\d+)', output)[1:] # skip file name on first line
         self._rpaths = []
-        load_commands = collections.deque(load_commands)
-        while load_commands:
-            load_commands.popleft() # command index
-            command = load_commands.popleft().strip().splitlines()
-            if command[0].find('LC_RPATH') == -1:
-                continue
-            
-            path = re.findall('path (.+) \(offset \d+\)$', command[2])[0]
+        for path in self.load_info_for_arch.rpaths:
             image_path = self.image_path_for_recorded_path(path)
             image_path.rpath_source = self
             self._rpaths.append(image_path)
 
+    def install_name(self):
+        if not self.load_info_for_arch:
+            return None
+        return self.load_info_for_arch.install_name
+
     def ancestors(self):
         ancestors = []
         parent = self.parent
@@ -80,6 +529,20 @@ class MachOFile:
         for image in self.self_and_ancestors():
             rpaths.extend(image.rpaths())
         return rpaths
+
+    def effective_rpaths(self):
+        # The rpaths searched for this image's @rpath dependencies, in search order,
+        # computed once from the parent's list. A directory that is already in the
+        # list earlier can never win and is left out.
+        if self._effective_rpaths is None:
+            inherited = self.parent.effective_rpaths() if self.parent else []
+            self._effective_rpaths = []
+            seen = set()
+            for rpath in self.rpaths() + inherited:
+                if rpath.resolved_path and rpath.resolved_path not in seen:
+                    seen.add(rpath.resolved_path)
+                    self._effective_rpaths.append(rpath)
+        return self._effective_rpaths
     
     def root(self):
         if not self.parent:
@@ -102,17 +565,19 @@ class MachOFile:
         return self.filetype() == MachOFile.MH_EXECUTE
         
     def all_dependencies(self):
+        # This image and everything it loads, in the order the images were first reached
         self.walk_dependencies()
-        return self.cache()['order']
+        reachable = set([id(self)])
+        stack = [self]
+        while stack:
+            for item in stack.pop().dependencies():
+                if id(item) not in reachable:
+                    reachable.add(id(item))
+                    stack.append(item)
+        return [image for image in self.session.order if id(image) in reachable]
     
-    def walk_dependencies(self, known = {}):
-        if known.get(self.image_path.resolved_path):
-            return
-        
-        known[self.image_path.resolved_path] = self
-        
-        for item in self.dependencies():
-            item.walk_dependencies(known)
+    def walk_dependencies(self):
+        self.session.walk(self)
         
     def dependencies(self):
         if not self.image_path.exists():
@@ -121,48 +586,27 @@ class MachOFile:
         if self._dependencies:
             return self._dependencies
 
-        output = self.shell('otool -arch {0} -L "{1}"', [self.arch, self.image_path.resolved_path], fatal = True)
-        output = [line.strip() for line in output.splitlines()]
-        del(output[0])
-        if self.is_dylib():
-            del(output[0]) # In the case of dylibs, the first line is the id line
+        image_paths = [self.image_path_for_recorded_path(recorded_path) for command_name, recorded_path in self.load_info_for_arch.dependencies]
+        for image_path in image_paths:
+            if not self.session.image_for_path(image_path.resolved_path):
+                self.session.loader.prefetch(image_path.resolved_path)
 
         self._dependencies = []
-        for line in output:
-            match = re.match('^(.+)\s+(\(.+)\)$', line)
-            if not match:
-                continue
-            recorded_path = match.group(1)
-            image_path = self.image_path_for_recorded_path(recorded_path)
+        for image_path in image_paths:
             image = self.lookup_or_make_item(image_path)
             self._dependencies.append(image)
             
         return self._dependencies
 
-    # The root item holds the cache, all lower-level requests bubble up the parent chain
-    def cache(self):
-        if self.parent:
-            return self.parent.cache()
-        return self._cache
-    
-    def add_to_cache(self):
-        cache = self.cache()
-        cache['paths'][self.image_path.resolved_path] = self
-        cache['order'].append(self)
-        
-    def cached_item_for_path(self, path):
-        if not path:
-            return None
-        return self.cache()['paths'].get(path)
-    
     def lookup_or_make_item(self, image_path):
-        image = self.cached_item_for_path(image_path.resolved_path)
+        image = self.session.image_for_path(image_path.resolved_path)
         if not image: # cache miss
-            image = MachOFile(image_path, self.arch, parent = self, verbose = self.verbose)
+            image = MachOFile(image_path, self.session, parent = self)
         return image
 
     def image_path_for_recorded_path(self, recorded_path):
         path = ImagePath(None, recorded_path)
+        path.path_exists = self.session.path_exists
 
         # handle @executable_path       
         if recorded_path.startswith(ImagePath.EXECUTABLE_PATH_TOKEN):
@@ -170,30 +614,30 @@ class MachOFile:
             if executable_image_path:
                 path.resolved_path = os.path.normpath(recorded_path.replace(ImagePath.EXECUTABLE_PATH_TOKEN, os.path.dirname(executable_image_path.resolved_path)))
                 if self.verbose:
-                    print "@executable_path: resolved {} to {}".format(recorded_path, path.resolved_path)
+                    print >> self.session.verbose_output, "@executable_path: resolved {} to {}".format(recorded_path, path.resolved_path)
 
         # handle @loader_path
         elif recorded_path.startswith(ImagePath.LOADER_PATH_TOKEN):
             path.resolved_path = os.path.normpath(recorded_path.replace(ImagePath.LOADER_PATH_TOKEN, os.path.dirname(self.image_path.resolved_path)))
             if self.verbose:
-                print "@loader_path: resolved {} to {}".format(recorded_path, path.resolved_path)
+                print >> self.session.verbose_output, "@loader_path: resolved {} to {}".format(recorded_path, path.resolved_path)
 
         # handle @rpath
         elif recorded_path.startswith(ImagePath.RPATH_TOKEN):
-            for rpath in self.all_rpaths():
+            for rpath in self.effective_rpaths():
                 resolved_path = os.path.normpath(recorded_path.replace(ImagePath.RPATH_TOKEN, rpath.resolved_path))
-                if os.path.exists(resolved_path):
+                if self.session.path_exists(resolved_path):
                     path.resolved_path = resolved_path
                     path.rpath_source = rpath.rpath_source
                     if self.verbose:
-                        print "@rpath: resolved {} to {} (source {})".format(recorded_path, path.resolved_path, rpath.rpath_source)
+                        print >> self.session.verbose_output, "@rpath: resolved {} to {} (source {})".format(recorded_path, path.resolved_path, rpath.rpath_source)
                     break
 
         # handle absolute path
         elif recorded_path.startswith('/'):
             path.resolved_path = recorded_path
             if self.verbose:
-                print "absolute path: resolved {} to {}".format(recorded_path, path.resolved_path)
+                print >> self.session.verbose_output, "absolute path: resolved {} to {}".format(recorded_path, path.resolved_path)
 
         else:
             print >> sys.stderr, "image_path_for_recorded_path: recorded_path {} doesn't match any cases".format(recorded_path)
@@ -208,30 +652,186 @@ class MachOFile:
         for dependency in self.dependencies():
             print '\t{0}'.format(dependency)
     
-    @staticmethod
-    def shell(cmd_format, args, fatal = False):
-        cmd = cmd_format.format(*args)
-        popen = subprocess.Popen(cmd, shell = True, stdout = subprocess.PIPE)
-        output = popen.communicate()[0]
-        if popen.returncode and fatal:
-            print >> sys.stderr, 'Nonzero exit status for shell command "{0}"'.format(cmd)
-            sys.exit(1)
-
-        return output
-
     @classmethod
     def architectures_for_image_at_path(cls, path):
-        output = cls.shell('file "{}"', [path])
-        file_architectures = re.findall(r' executable (\w+)', output)
-        ordering = 'x86_64 i386 arm64e'.split()
-        file_architectures = sorted(file_architectures, lambda a, b: cmp(ordering.index(a), ordering.index(b)))
-        return file_architectures
+        return MachOReader(path).preferred_architectures()
 
     MH_EXECUTE = 0x2
     MH_DYLIB = 0x6
     MH_BUNDLE = 0x8
     
 
+# Collects problems across all images of one shared graph
+class DependencyIssueReport:
+
+    def __init__(self, images, include_system_libraries = False):
+        self.missing = []
+        self.unresolved_rpaths = []
+        self.duplicate_install_names = []
+
+        for image in images:
+            for dependency in image.dependencies():
+                image_path = dependency.image_path
+                if image_path.uses_rpath_token() and not image_path.resolved_path:
+                    self.unresolved_rpaths.append((image, image_path))
+                elif not image_path.exists() and (include_system_libraries or not image_path.is_system_location()):
+                    self.missing.append((image, image_path))
+
+        paths_for_install_name = collections.defaultdict(set)
+        for image in images:
+            install_name = image.install_name()
+            if install_name:
+                paths_for_install_name[install_name].add(os.path.realpath(image.image_path.resolved_path))
+        for install_name, paths in sorted(paths_for_install_name.items()):
+            if len(paths) > 1:
+                self.duplicate_install_names.append((install_name, sorted(paths)))
+
+    def issue_count(self):
+        return len(self.missing) + len(self.unresolved_rpaths) + len(self.duplicate_install_names)
+
+    def dump(self):
+        print 'Missing dependencies: {0}'.format(len(self.missing))
+        for image, image_path in self.missing:
+            print '\t{0} needs {1}'.format(image.image_path.resolved_path, image_path.recorded_path)
+        print 'Unresolved @rpath dependencies: {0}'.format(len(self.unresolved_rpaths))
+        for image, image_path in self.unresolved_rpaths:
+            print '\t{0} needs {1}'.format(image.image_path.resolved_path, image_path.recorded_path)
+        print 'Duplicate install names: {0}'.format(len(self.duplicate_install_names))
+        for install_name, paths in self.duplicate_install_names:
+            print '\t{0}:'.format(install_name)
+            for path in paths:
+                print '\t\t{0}'.format(path)
+
+
+# Writes the graph of one session as a stream, one image at a time, so that large
+# graphs are never rendered as a whole in memory. Subclasses define the format.
+class GraphExporter:
+
+    def __init__(self, images, output):
+        self.images = images
+        self.output = output
+
+    def export(self):
+        node_ids = dict((id(image), node_id) for node_id, image in enumerate(self.images))
+        self.write_header()
+        for node_id, image in enumerate(self.images):
+            edges = [(node_ids[id(dependency)], dependency.image_path.recorded_path) for dependency in image.dependencies()]
+            self.write_node(node_id, GraphExporter.node_attributes(image), edges)
+        self.write_footer()
+
+    @staticmethod
+    def node_attributes(image):
+        image_path = image.image_path
+        rpath_source = image_path.rpath_source.image_path.resolved_path if image_path.rpath_source else None
+        return collections.OrderedDict([
+            ('recorded_path', image_path.recorded_path),
+            ('resolved_path', image_path.resolved_path),
+            ('rpath_source', rpath_source),
+            ('system', bool(image_path.is_system_location())),
+            ('missing', not image_path.exists()),
+        ])
+
+
+class JSONGraphExporter(GraphExporter):
+
+    def write_header(self):
+        self.output.write('{"nodes": [\n')
+
+    def write_node(self, node_id, attributes, edges):
+        node = collections.OrderedDict([('id', node_id)])
+        node.update(attributes)
+        node['dependencies'] = [dict(node = target_id, recorded_path = recorded_path) for target_id, recorded_path in edges]
+        self.output.write('{0}{1}'.format(',\n' if node_id else '', json.dumps(node)))
+
+    def write_footer(self):
+        self.output.write('\n]}\n')
+
+
+class DOTGraphExporter(GraphExporter):
+
+    def write_header(self):
+        self.output.write('digraph dependencies {\n')
+
+    def write_node(self, node_id, attributes, edges):
+        label = attributes['resolved_path'] or attributes['recorded_path']
+        node_attributes = ['label={0}'.format(DOTGraphExporter.quote(label))]
+        node_attributes.extend('{0}={1}'.format(key, DOTGraphExporter.quote(value)) for key, value in attributes.items() if value is not None)
+        if attributes['missing']:
+            node_attributes.append('color=red')
+        elif attributes['system']:
+            node_attributes.append('color=gray')
+        self.output.write('\tn{0} [{1}];\n'.format(node_id, ', '.join(node_attributes)))
+        for target_id, recorded_path in edges:
+            self.output.write('\tn{0} -> n{1} [label={2}];\n'.format(node_id, target_id, DOTGraphExporter.quote(recorded_path)))
+
+    def write_footer(self):
+        self.output.write('}\n')
+
+    @staticmethod
+    def quote(value):
+        if isinstance(value, bool):
+            value = str(value).lower()
+        return '"{0}"'.format(str(value).replace('\\', '\\\\').replace('"', '\\"'))
+
+    
+# Compares the analyses of several architectures image by image and lists, side by
+# side, the dependencies, rpaths and images that only some architectures have.
+class ArchitectureComparison:
+
+    def __init__(self, sessions):
+        self.archs = [session.arch for session in sessions]
+        # (resolved path, [(kind, value, [present for each architecture])]) tuples
+        self.differences = []
+
+        paths = []
+        seen_paths = set()
+        for session in sessions:
+            for image in session.order:
+                path = image.image_path.resolved_path
+                if path and path not in seen_paths:
+                    seen_paths.add(path)
+                    paths.append(path)
+
+        for path in paths:
+            entries_for_arch = [ArchitectureComparison.entries_for_image(session.image_for_path(path)) for session in sessions]
+            rows = []
+            seen_entries = set()
+            for entries in entries_for_arch:
+                for entry in entries:
+                    if entry in seen_entries:
+                        continue
+                    seen_entries.add(entry)
+                    present = [entry in arch_entries for arch_entries in entries_for_arch]
+                    if not all(present):
+                        rows.append(entry + (present,))
+            if rows and rows[0][0] == 'image':
+                # The image itself is missing in some architecture, its contents don't need listing
+                rows = rows[:1]
+            if rows:
+                self.differences.append((path, rows))
+
+    @staticmethod
+    def entries_for_image(image):
+        if not image:
+            return []
+        entries = [('image', '')]
+        if image.load_info_for_arch:
+            entries.extend(('rpath', rpath) for rpath in image.load_info_for_arch.rpaths)
+            entries.extend(('dependency', recorded_path) for command_name, recorded_path in image.load_info_for_arch.dependencies)
+        return entries
+
+    def dump(self):
+        print 'Architecture differences ({0}): {1}'.format(', '.join(self.archs), len(self.differences))
+        labels = ['{0} {1}'.format(kind, value).strip() for path, rows in self.differences for kind, value, present in rows]
+        label_width = max([len(label) for label in labels] + [0])
+        arch_width = max(len(arch) for arch in self.archs)
+        for path, rows in self.differences:
+            print '\t{0}:'.format(path)
+            for kind, value, present in rows:
+                columns = [(arch if is_present else '-').ljust(arch_width) for arch, is_present in zip(self.archs, present)]
+                print '\t\t{0}  {1}'.format('{0} {1}'.format(kind, value).strip().ljust(label_width), '  '.join(columns).rstrip())
+
+
 # ANSI terminal coloring sequences
 class Color:
     HEADER = '\033[95m'
@@ -265,6 +865,8 @@ class ImagePath:
         self.recorded_path = recorded_path
         self.resolved_path = resolved_path
         self.rpath_source = None
+        # Paths created during an analysis check for existence through the session's probe cache
+        self.path_exists = os.path.exists
         
     def __repr__(self):
         description = None
@@ -286,13 +888,16 @@ class ImagePath:
         return description
     
     def exists(self):
-        return self.resolved_path and os.path.exists(self.resolved_path)
+        return self.resolved_path and self.path_exists(self.resolved_path)
     
     def resolved_equals_recorded(self):
         return self.resolved_path and self.recorded_path and self.resolved_path == self.recorded_path
     
     def uses_dyld_token(self):
         return self.recorded_path and self.recorded_path.startswith('@')
+
+    def uses_rpath_token(self):
+        return self.recorded_path and self.recorded_path.startswith(ImagePath.RPATH_TOKEN)
     
     def is_system_location(self):
         system_prefixes = ['/System/Library', '/usr/lib']
@@ -306,27 +911,118 @@ class ImagePath:
 
 
 # Command line driver
-parser = optparse.OptionParser(usage = "Usage: %prog [options] path_to_mach_o_file")
-parser.add_option("--arch", dest = "arch", help = "architecture", metavar = "ARCH")
-parser.add_option("--all", dest = "include_system_libraries", help = "Include system frameworks and libraries", action="store_true")
-parser.add_option("--verbose", dest = "verbose", help = "Turn on verbose mode", action="store_true", default=False)
-(options, args) = parser.parse_args()
+def main():
+    parser = optparse.OptionParser(usage = "Usage: %prog [options] path_to_mach_o_file_or_bundle [...]")
+    parser.add_option("--arch", dest = "arch", help = "architecture, or all to analyze every architecture of the first image and compare them", metavar = "ARCH")
+    parser.add_option("--all", dest = "include_system_libraries", help = "Include system frameworks and libraries", action="store_true")
+    parser.add_option("--verbose", dest = "verbose", help = "Turn on verbose mode", action="store_true", default=False)
+    parser.add_option("--issues", dest = "issues_only", help = "Only print the report of missing, unresolved @rpath and duplicate install name issues", action="store_true", default=False)
+    parser.add_option("--cache-path", dest = "cache_path", help = "Path of the persistent cache of parsed images, default {0}".format(ImageInfoCache.default_path()), metavar = "PATH")
+    parser.add_option("--no-cache", dest = "use_cache", help = "Do not use the persistent cache of parsed images", action = "store_false", default = True)
+    parser.add_option("--format", dest = "format", help = "Output format, one of text (default), json or dot. json and dot export the whole dependency graph", choices = ['text', 'json', 'dot'], default = 'text')
+    parser.add_option("--output", dest = "output_path", help = "Write the json or dot graph to PATH instead of stdout", metavar = "PATH")
+    parser.add_option("--jobs", dest = "jobs", help = "Number of threads that read images ahead of the dependency walk, default 8", type = "int", default = 8)
+    (options, args) = parser.parse_args()
+
+    if len(args) < 1:
+        parser.print_help()
+        sys.exit(1)
+
+    # Directories such as app bundles are searched for all Mach-O files they contain
+    toplevel_paths = []
+    for arg in args:
+        toplevel_paths.extend(MachOReader.find_macho_files(os.path.abspath(arg)))
+    if not toplevel_paths:
+        print >> sys.stderr, 'No Mach-O files found in {0}'.format(', '.join(args))
+        sys.exit(1)
+    is_multi_image_audit = len(toplevel_paths) > 1 or os.path.isdir(args[0])
+
+    # Start with executables so that libraries are reached through their loading chain,
+    # which supplies the rpaths needed to resolve their own @rpath dependencies
+    def is_executable_path(path):
+        info = MachOReader(path).load_info(None)
+        return info and info.header_info.get('filetype') == MachOFile.MH_EXECUTE
+    toplevel_paths.sort(key = lambda path: 0 if is_executable_path(path) else 1)
+
+    # The architectures of all toplevel images, those of the main executable first
+    architectures_by_path = {}
+    archs = []
+    for path in toplevel_paths:
+        architectures_by_path[path] = MachOFile.architectures_for_image_at_path(path)
+        archs.extend([arch for arch in architectures_by_path[path] if arch not in archs])
+
+    if options.arch == 'all':
+        if not archs:
+            print >> sys.stderr, 'No architectures found in {0}, is it a Mach-O image?'.format(', '.join(args))
+            sys.exit(1)
+        analysis_archs = archs
+        print >> sys.stderr, 'Analyzing architectures {0}'.format(', '.join(archs))
+        if options.format != 'text':
+            parser.error('--format {0} needs a single --arch'.format(options.format))
+    else:
+        if archs and not options.arch:
+            print >> sys.stderr, 'Analyzing architecture {}, override with --arch if needed'.format(archs[0])
+            options.arch = archs[0]
+        analysis_archs = [options.arch]
+
+    # Keep diagnostics out of a graph that is exported to stdout
+    diagnostics_output = sys.stderr if options.format != 'text' and not options.output_path else sys.stdout
+
+    persistent_cache = None
+    if options.use_cache:
+        persistent_cache = ImageInfoCache(options.cache_path)
+
+    # One loader reads every analyzed architecture of each image at once
+    loader = ImageInfoLoader(analysis_archs, options.jobs, persistent_cache)
+
+    sessions = []
+    for arch in analysis_archs:
+        # All toplevel images share one session per architecture, so each image is analyzed once no matter how many others link it
+        session = AnalysisSession(arch, options.jobs, persistent_cache, options.verbose, loader, diagnostics_output)
+        sessions.append(session)
+        if len(analysis_archs) > 1:
+            print 'Architecture {0}:'.format(arch)
+
+        for path in toplevel_paths:
+            if (is_multi_image_audit or len(analysis_archs) > 1) and arch not in architectures_by_path[path]:
+                print >> sys.stderr, 'Skipping {0}, it has no {1} slice'.format(path, arch)
+                continue
+            try:
+                session.toplevel_image(path)
+            except MachOHeaderError as e:
+                print >> sys.stderr, e
+                sys.exit(1)
+        all_images = session.order
+
+        if options.format != 'text' and not options.issues_only:
+            exporter_class = JSONGraphExporter if options.format == 'json' else DOTGraphExporter
+            output = open(options.output_path, 'w') if options.output_path else sys.stdout
+            exporter_class(all_images, output).export()
+            if options.output_path:
+                output.close()
+        elif not options.issues_only:
+            for dependency in all_images:
+                if dependency.image_path.exists() and (not options.include_system_libraries) and dependency.image_path.is_system_location():
+                    continue
 
-if len(args) < 1:
-    parser.print_help()
-    sys.exit(1)
+                dependency.dump()
+                print
 
-archs = MachOFile.architectures_for_image_at_path(os.path.abspath(args[0]))
-if archs and not options.arch:
-    print >> sys.stderr, 'Analyzing architecture {}, override with --arch if needed'.format(archs[0])
-    options.arch = archs[0]
+        if options.issues_only or (is_multi_image_audit and options.format == 'text'):
+            DependencyIssueReport(all_images, options.include_system_libraries).dump()
+        session.close()
 
-toplevel_image = MachOFile(ImagePath(os.path.abspath(args[0])), options.arch)
+    if len(sessions) > 1:
+        ArchitectureComparison(sessions).dump()
 
-for dependency in toplevel_image.all_dependencies():
-    if dependency.image_path.exists() and (not options.include_system_libraries) and dependency.image_path.is_system_location():
-        continue
+    loader.shutdown()
+    if options.verbose:
+        print >> diagnostics_output, 'Filesystem probes: {0} lookup(s), {1} stat call(s)'.format(sum(session.probe_count for session in sessions), sum(session.stat_count for session in sessions))
+    if persistent_cache:
+        if options.verbose:
+            print >> diagnostics_output, 'Image cache: {0} hit(s), {1} miss(es)'.format(persistent_cache.hits, persistent_cache.misses)
+        persistent_cache.close()
 
-    dependency.dump()
-    print
 
+if __name__ == '__main__':
+    main()
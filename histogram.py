@@ -14,14 +14,424 @@ import logging
 import fileinput
 import subprocess
 import collections
+import multiprocessing
+import threading
+import time
+import gzip
+import marshal
+import heapq
+import calendar
 
 
+class CostInfo(object):
+
+    def __init__(self):
+        self.count = 0
+        self.total_cost = 0
+
+    def update(self, cost=1):
+        self.count += 1
+        self.total_cost += cost
+
+    def merge(self, other):
+        self.count += other.count
+        self.total_cost += other.total_cost
+
+    def snapshot_state(self):
+        return self.count, self.total_cost
+
+    @classmethod
+    def from_snapshot_state(cls, state):
+        info = cls()
+        info.count, info.total_cost = state
+        return info
+
+
+class BucketCostInfo(object):
+
+    def __init__(self):
+        self.count = 0
+        self.total_cost = 0
+        self.item_counter = collections.Counter()
+
+    def update(self, cost, item):
+        self.count += 1
+        self.total_cost += cost
+        self.item_counter.update([item])
+
+    def merge(self, other):
+        self.count += other.count
+        self.total_cost += other.total_cost
+        self.item_counter.update(other.item_counter)
+
+    def snapshot_state(self):
+        return self.count, self.total_cost, dict(self.item_counter)
+
+    @classmethod
+    def from_snapshot_state(cls, state):
+        info = cls()
+        info.count, info.total_cost, item_counts = state
+        info.item_counter.update(item_counts)
+        return info
+
+
+# Streaming quantile sketch with log-spaced buckets in the style of DDSketch.
+# Any quantile it reports is within the relative accuracy of the true value, the
+# bucket count is capped so memory stays constant, and two sketches merge
+# exactly by adding up their bucket counts.
+class QuantileSketch(object):
+
+    RELATIVE_ACCURACY = 0.01
+    # Enough buckets for about eight orders of magnitude at 1% accuracy. Beyond
+    # that the lowest buckets are folded together, which only affects low quantiles.
+    MAX_BUCKETS = 1024
+
+    def __init__(self):
+        self.gamma = (1 + self.RELATIVE_ACCURACY) / (1 - self.RELATIVE_ACCURACY)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if value <= 0:
+            self.zero_count += 1
+            return
+        index = int(math.ceil(math.log(value) / self.log_gamma))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        if len(self.buckets) > self.MAX_BUCKETS:
+            self.collapse()
+
+    def collapse(self):
+        indexes = sorted(self.buckets)
+        excess = len(indexes) - self.MAX_BUCKETS
+        target = indexes[excess]
+        for index in indexes[:excess]:
+            self.buckets[target] += self.buckets.pop(index)
+
+    def merge(self, other):
+        if not other.count:
+            return
+        self.count += other.count
+        self.zero_count += other.zero_count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        if len(self.buckets) > self.MAX_BUCKETS:
+            self.collapse()
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return max(self.min, 0)
+        seen = self.zero_count
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                # Midpoint of the bucket in relative terms, clamped to the observed range
+                value = 2 * self.gamma ** index / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def snapshot_state(self):
+        return self.count, self.zero_count, self.min, self.max, self.buckets
+
+    @classmethod
+    def from_snapshot_state(cls, state):
+        sketch = cls()
+        sketch.count, sketch.zero_count, sketch.min, sketch.max, buckets = state
+        sketch.buckets.update(buckets)
+        return sketch
+
+
+# Extractors turn an input line into an (item, cost) pair. They return None if
+# the line should be skipped silently and a None cost if a cost was expected
+# but not found. Lines are byte strings read through a binary reader.
+class FindallExtractor(object):
+
+    # The original extraction code, kept as the --benchmark baseline
+
+    def __init__(self, item_regex=None, cost_regex=None):
+        self.item_regex = item_regex
+        self.cost_regex = cost_regex
+
+    def extract(self, line):
+        item_identifier = line
+        if self.item_regex:
+            values = self.item_regex.findall(line)
+            if not values:
+                return None
+            item_identifier = values[0]
+        cost = 1.0
+        if self.cost_regex:
+            values = self.cost_regex.findall(line)
+            if not values:
+                return item_identifier, None
+            cost = float(values[0])
+        return item_identifier, cost
+
+
+class RegexExtractor(object):
+
+    # Line processing is dominated by per-call interpreter overhead, so extract()
+    # is a closure specialized for the given patterns and group layout
+
+    def __init__(self, item_regex=None, cost_regex=None, key_groups=False):
+        self.item_regex = item_regex
+        self.cost_regex = cost_regex
+        # If set, the item is a tuple of the named groups (or of all groups if there are no named ones)
+        self.key_groups = key_groups
+        self.compile()
+
+    def __getstate__(self):
+        # Closures cannot be pickled for the worker processes, they are rebuilt on unpickling
+        state = self.__dict__.copy()
+        del state['extract']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.compile()
+
+    @classmethod
+    def value_getter(cls, index, group_count):
+        # Produces the same value that findall()[0] would: the whole match, the only group or a tuple of all groups
+        if group_count == 0:
+            return lambda match: match.group(index)
+        if group_count == 1:
+            # An optional group that did not participate is None here but '' in findall()
+            return lambda match: match.group(index + 1) or ''
+        indexes = range(index + 1, index + 1 + group_count)
+        return lambda match: tuple([value or '' for value in match.group(*indexes)])
+
+    def key_group_indexes(self):
+        return sorted(self.item_regex.groupindex.values()) or range(1, self.item_regex.groups + 1) or [0]
+
+    def key_group_names(self):
+        names = dict([(i, name) for name, i in self.item_regex.groupindex.items()])
+        return [names.get(i, str(i)) for i in self.key_group_indexes()]
+
+    def key_getter(self, index):
+        indexes = [index + i for i in self.key_group_indexes()]
+        if len(indexes) == 1:
+            return lambda match: (match.group(indexes[0]) or '',)
+        return lambda match: tuple([value or '' for value in match.group(*indexes)])
+
+    def item_value_getter(self, index):
+        if self.key_groups:
+            return self.key_getter(index)
+        return self.value_getter(index, self.item_regex.groups)
+
+    def compile(self):
+        item_regex, cost_regex = self.item_regex, self.cost_regex
+
+        if item_regex and cost_regex:
+            # Two separate searches. A single match on both patterns in lookaheads was
+            # slower for most patterns because of the backtracking over the line prefix.
+            item_search = item_regex.search
+            cost_search = cost_regex.search
+            cost_value = self.value_getter(0, cost_regex.groups)
+
+            if item_regex.groups == 1 and cost_regex.groups == 1 and not self.key_groups:
+                def extract(line):
+                    match = item_search(line)
+                    if match is None:
+                        return None
+                    cost_match = cost_search(line)
+                    if cost_match is None:
+                        return match.group(1) or '', None
+                    return match.group(1) or '', float(cost_match.group(1))
+            else:
+                item_value = self.item_value_getter(0)
+                def extract(line):
+                    match = item_search(line)
+                    if match is None:
+                        return None
+                    cost_match = cost_search(line)
+                    if cost_match is None:
+                        return item_value(match), None
+                    return item_value(match), float(cost_value(cost_match))
+
+        elif item_regex:
+            item_search = item_regex.search
+            if item_regex.groups == 1 and not self.key_groups:
+                def extract(line):
+                    match = item_search(line)
+                    if match is None:
+                        return None
+                    return match.group(1) or '', 1.0
+            else:
+                item_value = self.item_value_getter(0)
+                def extract(line):
+                    match = item_search(line)
+                    if match is None:
+                        return None
+                    return item_value(match), 1.0
+
+        elif cost_regex:
+            cost_search = cost_regex.search
+            cost_value = self.value_getter(0, cost_regex.groups)
+            def extract(line):
+                match = cost_search(line)
+                if match is None:
+                    return line, None
+                return line, float(cost_value(match))
+
+        else:
+            def extract(line):
+                return line, 1.0
+
+        self.extract = extract
+
+
+class FieldExtractor(object):
+
+    # awk-style column extraction without any regular expression work
+
+    def __init__(self, separator=None, item_fields=None, cost_field=None, key_groups=False):
+        self.separator = separator
+        self.key_groups = key_groups
+        self.item_fields = [i - 1 for i in item_fields or []]
+        self.cost_field = cost_field - 1 if cost_field else None
+        self.join_separator = separator or ' '
+        self.max_split = max(self.item_fields + [self.cost_field or 0]) + 1
+
+    def extract(self, line):
+        fields = line.split(self.separator, self.max_split)
+        field_count = len(fields)
+        item_identifier = line
+        if self.item_fields:
+            if max(self.item_fields) >= field_count:
+                return None
+            if self.key_groups:
+                item_identifier = tuple([fields[i].rstrip('\r\n') for i in self.item_fields])
+            elif len(self.item_fields) == 1:
+                item_identifier = fields[self.item_fields[0]]
+            else:
+                item_identifier = self.join_separator.join([fields[i] for i in self.item_fields])
+            if self.separator and not self.key_groups:
+                # Without a separator, split() already dropped the line terminator
+                item_identifier = item_identifier.rstrip('\r\n')
+        cost = 1.0
+        if self.cost_field is not None:
+            if self.cost_field >= field_count:
+                return item_identifier, None
+            try:
+                cost = float(fields[self.cost_field])
+            except ValueError:
+                # For example a header line
+                return item_identifier, None
+        return item_identifier, cost
+
+    def key_group_names(self):
+        return ['field {}'.format(i + 1) for i in self.item_fields]
+
+    @classmethod
+    def field_list(cls, value):
+        return [int(i) for i in value.split(',')]
+
+
+# Parses timestamps at a fixed position and in a fixed-width format, e.g. the
+# "2023-01-02 12:34:56" prefix of "log stream" lines or the "Jan  2 12:34:56" prefix
+# of syslog lines. This avoids strptime() and dateparser, the date part is
+# converted only once per distinct day. Timestamps are treated as UTC, which is
+# good enough for bucketing.
+class TimestampParser(object):
+
+    DIRECTIVE_WIDTHS = {'Y': 4, 'y': 2, 'm': 2, 'd': 2, 'e': 2, 'H': 2, 'M': 2, 'S': 2, 'b': 3}
+    MONTH_ABBREVIATIONS = dict([(name, i + 1) for i, name in enumerate('Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec'.split())])
+
+    def __init__(self, time_format='%Y-%m-%d %H:%M:%S', column=0):
+        self.time_format = time_format
+        self.fields = {}
+        offset = column
+        i = 0
+        while i < len(time_format):
+            if time_format[i] == '%' and i + 1 < len(time_format):
+                directive = time_format[i + 1]
+                if directive not in self.DIRECTIVE_WIDTHS:
+                    raise Exception('Unsupported directive %{} in time format "{}"'.format(directive, time_format))
+                width = self.DIRECTIVE_WIDTHS[directive]
+                self.fields[directive] = (offset, offset + width)
+                offset += width
+                i += 2
+            else:
+                offset += 1
+                i += 1
+        self.end = offset
+        self.day_slices = [self.fields[d] for d in 'Yymbde' if d in self.fields]
+        self.default_year = time.gmtime().tm_year
+        self.day_start_cache = {}
+
+    def field_value(self, line, directive, default):
+        if directive not in self.fields:
+            return default
+        start, end = self.fields[directive]
+        value = line[start:end]
+        if directive == 'b':
+            return self.MONTH_ABBREVIATIONS[value]
+        return int(value)
+
+    def day_start(self, line):
+        year = self.field_value(line, 'Y', None)
+        if year is None:
+            year = self.field_value(line, 'y', self.default_year % 100) + 2000
+        month = self.field_value(line, 'm', None) or self.field_value(line, 'b', 1)
+        day = self.field_value(line, 'd', None) or self.field_value(line, 'e', 1)
+        return calendar.timegm((year, month, day, 0, 0, 0))
+
+    def parse(self, line):
+        # Returns seconds since the epoch or None if the line has no valid timestamp
+        if len(line) < self.end:
+            return None
+        try:
+            day_key = tuple([line[start:end] for start, end in self.day_slices])
+            day_start = self.day_start_cache.get(day_key)
+            if day_start is None:
+                day_start = self.day_start_cache[day_key] = self.day_start(line)
+            return day_start + self.field_value(line, 'H', 0) * 3600 + self.field_value(line, 'M', 0) * 60 + self.field_value(line, 'S', 0)
+        except (ValueError, KeyError):
+            return None
+
+
+class TimeBucketExtractor(object):
+
+    # Wraps another extractor and turns its item into a (time bucket, item) pair
+
+    def __init__(self, extractor, timestamp_parser, bucket_seconds):
+        self.extractor = extractor
+        self.timestamp_parser = timestamp_parser
+        self.bucket_seconds = bucket_seconds
+
+    def extract(self, line):
+        values = self.extractor.extract(line)
+        if not values:
+            return values
+        timestamp = self.timestamp_parser.parse(line)
+        if timestamp is None:
+            return None
+        item_identifier, cost = values
+        return (int(timestamp // self.bucket_seconds), item_identifier), cost
+
 
 class BaseCounter(object):
+
+    SNAPSHOT_FORMAT_VERSION = 3
     
-    def __init__(self, item_regex=None, cost_regex=None, cost_coefficient=None, expand_tabs=None):
+    def __init__(self, item_regex=None, cost_regex=None, cost_coefficient=None, expand_tabs=None, extractor=None):
         self.item_regex = item_regex
         self.cost_regex = cost_regex
+        self.extractor = extractor or RegexExtractor(item_regex, cost_regex)
         self.cost_coefficient = cost_coefficient
         self.expand_tabs = expand_tabs
         self.total_count = 0
@@ -32,20 +442,15 @@ class BaseCounter(object):
         pass
 
     def update(self, iterable):
+        extract = self.extractor.extract
         for line in iterable:
-            item_identifier = line
-            if self.item_regex:
-                values = self.item_regex.findall(line)
-                if not values:
-                    continue
-                item_identifier = values[0]
-            cost = 1.0
-            if self.cost_regex:
-                values = self.cost_regex.findall(line)
-                if not values:
-                    print >> sys.stderr, 'Cost regex given, but input line does not match: "{}"'.format(line)
-                    continue
-                cost = float(values[0])
+            values = extract(line)
+            if not values:
+                continue
+            item_identifier, cost = values
+            if cost is None:
+                print >> sys.stderr, 'Cost regex or field given, but input line does not match: "{}"'.format(line)
+                continue
             if self.cost_coefficient:
                 cost *= self.cost_coefficient
             
@@ -56,9 +461,66 @@ class BaseCounter(object):
     def update_for_item_and_cost(self, item_identifier, cost):
         pass
 
+    def merge(self, other):
+        # Fold the partial state of another counter of the same type into this one
+        self.total_count += other.total_count
+        self.total_cost += other.total_cost
+        for key, value in other.data.items():
+            self.data[key].merge(value)
+
+    def snapshot_info_class(self):
+        return self.data.default_factory
+
+    def snapshot_state(self):
+        return {
+            'total_count': self.total_count,
+            'total_cost': self.total_cost,
+            'data': dict([(key, value.snapshot_state()) for key, value in self.data.items()]),
+        }
+
+    def merge_snapshot_state(self, state):
+        info_class = self.snapshot_info_class()
+        self.total_count += state['total_count']
+        self.total_cost += state['total_cost']
+        for key, value in state['data'].items():
+            self.data[key].merge(info_class.from_snapshot_state(value))
+
+    def save_snapshot(self, path):
+        # Snapshots hold only the aggregated state, not the raw lines, so they stay
+        # small and can be merged later without rereading the logs they came from.
+        # The state is plain data, marshal stores it without pickle's ability to run
+        # code on loading, so snapshots copied from other hosts are safe to merge.
+        state = self.snapshot_state()
+        state['version'] = self.SNAPSHOT_FORMAT_VERSION
+        state['counter'] = type(self).__name__
+        temp_path = path + '.tmp'
+        with gzip.open(temp_path, 'wb') as f:
+            f.write(marshal.dumps(state, 2))
+        os.rename(temp_path, path)
+
+    def merge_snapshot(self, path):
+        with gzip.open(path, 'rb') as f:
+            try:
+                state = marshal.loads(f.read())
+            except (ValueError, EOFError, TypeError):
+                raise Exception('"{}" is not a snapshot, or was written by an older version'.format(path))
+        if not isinstance(state, dict) or state.get('version') != self.SNAPSHOT_FORMAT_VERSION:
+            raise Exception('Unsupported snapshot format version {} in "{}"'.format(state.get('version'), path))
+        if state['counter'] != type(self).__name__:
+            raise Exception('Snapshot "{}" was written by {}, it cannot be merged into {}'.format(path, state['counter'], type(self).__name__))
+        self.merge_snapshot_state(state)
+
     def print_histogram(self):
         pass
 
+    def item_label(self, item):
+        # Items of an item regex with several groups are tuples
+        if isinstance(item, tuple):
+            item = ' '.join(item)
+        if self.expand_tabs:
+            item = item.expandtabs(self.expand_tabs)
+        return item.strip()
+
     @classmethod    
     def terminal_width(cls):
         with open('/dev/tty') as tty:
@@ -69,121 +531,679 @@ class BaseCounter(object):
 class DefaultCounter(BaseCounter):
         
     def setup_data(self):
-
-        class CostInfo(object):
-
-            def __init__(self):
-                self.count = 0
-                self.total_cost = 0
-            
-            def update(self, cost=1):
-                self.count += 1
-                self.total_cost += cost
-        
         self.data = collections.defaultdict(CostInfo)
         self.dump_buckets = False
+        self.top_count = None
 
     def update_for_item_and_cost(self, item_identifier, cost):
         self.data[item_identifier].update(cost)
 
-    def max_len_total_cost(self):
-        return max([len(str(i.total_cost)) for i in self.data.values()])
+    @classmethod
+    def max_len_total_cost(cls, items):
+        return max([len(str(i.total_cost)) for _, i in items])
 
     def sorted_items(self):
-        return sorted(self.data.items(), cmp=lambda a, b: cmp(b[1].total_cost, a[1].total_cost))
+        return sorted(self.data.items(), key=lambda x: x[1].total_cost, reverse=True)
+
+    def top_items(self, count):
+        # O(n log k) selection instead of sorting all n distinct items
+        return heapq.nlargest(count, self.data.items(), key=lambda x: x[1].total_cost)
 
     def print_histogram(self):
-        terminal_width = self.terminal_width()
+        if not self.top_count or len(self.data) <= self.top_count:
+            self.print_items(self.sorted_items(), self.total_cost)
+            return
+
+        items = self.top_items(self.top_count)
+        other_info = CostInfo()
+        other_info.count = self.total_count - sum([cost_info.count for _, cost_info in items])
+        other_info.total_cost = self.total_cost - sum([cost_info.total_cost for _, cost_info in items])
+        items.append(('({} other items)'.format(len(self.data) - len(items)), other_info))
+        self.print_items(items, self.total_cost)
 
-        sorted_items = self.sorted_items()
+    def print_items(self, sorted_items, total_cost):
+        terminal_width = self.terminal_width()
 
-        max_len_total_cost = self.max_len_total_cost()
+        max_len_total_cost = self.max_len_total_cost(sorted_items)
         item_width = terminal_width / 2
         max_bar_length = item_width - (13 + max_len_total_cost)
         scale = float(max_bar_length) / sorted_items[0][1].total_cost
 
         for item, cost_info in sorted_items:
-            if self.expand_tabs:
-                item = item.expandtabs(self.expand_tabs)
-            bar_length = int(scale * cost_info.total_cost)
-            percentage = int(cost_info.total_cost * 100 / self.total_cost)
-            print '{:{width}}  {:4} {:{width_cost}.0f} {:>3}% {}'.format(item.strip()[:item_width], cost_info.count, cost_info.total_cost, percentage, '*' * bar_length, width=item_width, width_cost=max_len_total_cost)
+            bar_length = min(int(scale * cost_info.total_cost), max_bar_length)
+            percentage = int(cost_info.total_cost * 100 / total_cost)
+            print '{:{width}}  {:4} {:{width_cost}.0f} {:>3}% {}'.format(self.item_label(item)[:item_width], cost_info.count, cost_info.total_cost, percentage, '*' * bar_length, width=item_width, width_cost=max_len_total_cost)
 
 
-class BucketCounter(BaseCounter):
+# One level of a hierarchical histogram. Each update walks the key path once and
+# adds to every node on the way, so all rollup totals come out of a single pass.
+class TreeNode(object):
+
+    def __init__(self):
+        self.count = 0
+        self.total_cost = 0
+        self.children = {}
+
+    def update(self, cost, keys):
+        node = self
+        node.count += 1
+        node.total_cost += cost
+        for key in keys:
+            child = node.children.get(key)
+            if child is None:
+                child = node.children[key] = TreeNode()
+            child.count += 1
+            child.total_cost += cost
+            node = child
+
+    def merge(self, other):
+        self.count += other.count
+        self.total_cost += other.total_cost
+        for key, other_child in other.children.items():
+            child = self.children.get(key)
+            if child is None:
+                child = self.children[key] = TreeNode()
+            child.merge(other_child)
+
+    def snapshot_state(self):
+        return self.count, self.total_cost, dict([(key, child.snapshot_state()) for key, child in self.children.items()])
+
+    @classmethod
+    def from_snapshot_state(cls, state):
+        node = cls()
+        node.count, node.total_cost, children = state
+        for key, child_state in children.items():
+            node.children[key] = cls.from_snapshot_state(child_state)
+        return node
+
+
+class TreeCounter(BaseCounter):
+
+    # Histogram over composite keys, e.g. host and endpoint, printed as an indented tree
+
+    INDENT = '  '
 
     def setup_data(self):
-        
-        class BucketCostInfo(object):
+        self.data = collections.defaultdict(TreeNode)
+        self.level_names = []
+        self.top_count = None
+
+    def update_for_item_and_cost(self, item_identifier, cost):
+        self.data[item_identifier[0]].update(cost, item_identifier[1:])
+
+    def sorted_children(self, children):
+        if self.top_count and len(children) > self.top_count:
+            return heapq.nlargest(self.top_count, children.items(), key=lambda x: x[1].total_cost)
+        return sorted(children.items(), key=lambda x: x[1].total_cost, reverse=True)
+
+    def print_histogram(self):
+        terminal_width = self.terminal_width()
+        max_len_total_cost = max([len(str(node.total_cost)) for node in self.data.values()])
+        item_width = terminal_width / 2
+        max_bar_length = item_width - (13 + max_len_total_cost)
+        scale = float(max_bar_length) / max([node.total_cost for node in self.data.values()])
+
+        if self.level_names:
+            print ' > '.join(self.level_names)
+
+        def print_level(children, parent_count, parent_cost, depth):
+            items = self.sorted_children(children)
+            indent = self.INDENT * depth
+            for key, node in items:
+                key = key.strip()
+                if self.expand_tabs:
+                    key = key.expandtabs(self.expand_tabs)
+                self.print_row(indent + key, node.count, node.total_cost, item_width, max_len_total_cost, max_bar_length, scale)
+                print_level(node.children, node.count, node.total_cost, depth + 1)
+            shown_count = sum([node.count for _, node in items])
+            if len(items) < len(children):
+                label = '{}({} other items)'.format(indent, len(children) - len(items))
+                self.print_row(label, parent_count - shown_count, parent_cost - sum([node.total_cost for _, node in items]), item_width, max_len_total_cost, max_bar_length, scale)
+
+        print_level(self.data, self.total_count, self.total_cost, 0)
+
+    def print_row(self, label, count, cost, item_width, max_len_total_cost, max_bar_length, scale):
+        bar_length = min(int(scale * cost), max_bar_length)
+        percentage = int(cost * 100 / self.total_cost)
+        print '{:{width}}  {:4} {:{width_cost}.0f} {:>3}% {}'.format(label[:item_width], count, cost, percentage, '*' * bar_length, width=item_width, width_cost=max_len_total_cost)
+
+
+class TimeSeriesCostInfo(CostInfo):
+
+    def __init__(self):
+        super(TimeSeriesCostInfo, self).__init__()
+        self.bucket_costs = {}
+
+    def update(self, cost=1, bucket=None):
+        super(TimeSeriesCostInfo, self).update(cost)
+        self.bucket_costs[bucket] = self.bucket_costs.get(bucket, 0) + cost
+
+    def merge(self, other):
+        super(TimeSeriesCostInfo, self).merge(other)
+        for bucket, cost in other.bucket_costs.items():
+            self.bucket_costs[bucket] = self.bucket_costs.get(bucket, 0) + cost
+
+    def snapshot_state(self):
+        return self.count, self.total_cost, self.bucket_costs
+
+    @classmethod
+    def from_snapshot_state(cls, state):
+        info = cls()
+        info.count, info.total_cost, bucket_costs = state
+        info.bucket_costs.update(bucket_costs)
+        return info
+
+
+class TimeSeriesCounter(DefaultCounter):
+
+    DEFAULT_TOP_COUNT = 20
+    SPARKLINE_CHARACTERS = u' \u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
+
+    def setup_data(self):
+        self.data = collections.defaultdict(TimeSeriesCostInfo)
+        self.bucket_seconds = 60
+        self.top_count = self.DEFAULT_TOP_COUNT
+
+    def update_for_item_and_cost(self, item_identifier, cost):
+        bucket, item_identifier = item_identifier
+        self.data[item_identifier].update(cost, bucket)
+
+    def snapshot_state(self):
+        # Buckets are stored as indexes, they only mean something together with their size
+        state = super(TimeSeriesCounter, self).snapshot_state()
+        state['bucket_seconds'] = self.bucket_seconds
+        return state
+
+    def merge_snapshot_state(self, state):
+        if state.get('bucket_seconds') != self.bucket_seconds:
+            raise Exception('Snapshot uses time buckets of {} second(s), they cannot be merged into buckets of {} second(s)'.format(state.get('bucket_seconds'), self.bucket_seconds))
+        super(TimeSeriesCounter, self).merge_snapshot_state(state)
+
+    def sparkline(self, bucket_costs, first_bucket, bucket_count, buckets_per_column, column_count):
+        columns = [0] * column_count
+        for bucket, cost in bucket_costs.items():
+            columns[(bucket - first_bucket) // buckets_per_column] += cost
+        max_cost = max(columns)
+        levels = len(self.SPARKLINE_CHARACTERS) - 1
+        characters = []
+        for cost in columns:
+            level = int(math.ceil(cost * levels / max_cost)) if cost > 0 and max_cost > 0 else 0
+            characters.append(self.SPARKLINE_CHARACTERS[level])
+        return u''.join(characters).encode('utf-8')
+
+    def print_histogram(self):
+        top_items = heapq.nlargest(self.top_count, self.data.items(), key=lambda x: x[1].total_cost)
+        # The time range spans all items, not just the top ones, so the columns of all rows line up
+        first_bucket = min([min(cost_info.bucket_costs) for cost_info in self.data.values()])
+        last_bucket = max([max(cost_info.bucket_costs) for cost_info in self.data.values()])
+        bucket_count = last_bucket - first_bucket + 1
+
+        terminal_width = self.terminal_width()
+        max_len_total_cost = self.max_len_total_cost(top_items)
+        item_width = min(max([len(self.item_label(item)) for item, _ in top_items]), terminal_width / 3)
+        max_column_count = max(terminal_width - (item_width + max_len_total_cost + 6), 10)
+        buckets_per_column = int(math.ceil(float(bucket_count) / max_column_count))
+        column_count = int(math.ceil(float(bucket_count) / buckets_per_column))
+
+        time_format = '%Y-%m-%d %H:%M:%S'
+        print '{} to {}, {} second(s) per column'.format(time.strftime(time_format, time.gmtime(first_bucket * self.bucket_seconds)), time.strftime(time_format, time.gmtime((last_bucket + 1) * self.bucket_seconds)), buckets_per_column * self.bucket_seconds)
+        for item, cost_info in top_items:
+            sparkline = self.sparkline(cost_info.bucket_costs, first_bucket, bucket_count, buckets_per_column, column_count)
+            print '{:{width}}  {:{width_cost}.0f} |{}|'.format(self.item_label(item)[:item_width], cost_info.total_cost, sparkline, width=item_width, width_cost=max_len_total_cost)
+
+
+# Exact top-k membership for scores that only ever increase. Items can only
+# enter the set when their own score grows past the current minimum, so each
+# update is O(1) except when the minimum member changes, which costs O(k).
+class TopItems(object):
+
+    def __init__(self, size):
+        self.size = size
+        self.members = {}
+        self.minimum_item = None
+        self.minimum_is_stale = False
+
+    def score(self, item):
+        return self.members[item].total_cost
+
+    def minimum_score(self):
+        if self.minimum_is_stale:
+            self.minimum_item = min(self.members, key=self.score)
+            self.minimum_is_stale = False
+        return self.score(self.minimum_item)
+
+    def update(self, item, cost_info):
+        if item in self.members:
+            if item == self.minimum_item:
+                self.minimum_is_stale = True
+            return
+        if len(self.members) < self.size:
+            self.members[item] = cost_info
+            self.minimum_is_stale = True
+            return
+        if cost_info.total_cost > self.minimum_score():
+            del self.members[self.minimum_item]
+            self.members[item] = cost_info
+            self.minimum_is_stale = True
+
+    def sorted_items(self):
+        return sorted(self.members.items(), key=lambda x: x[1].total_cost, reverse=True)
+
+
+class LiveCounter(DefaultCounter):
+
+    DEFAULT_TOP_COUNT = 20
+    # Forward-decayed values are renormalized before they can overflow,
+    # exp(230) is about 1e100 and far below the float limit of about exp(709)
+    MAX_DECAY_EXPONENT = 230
+
+    def setup_live(self, top_count=None, half_life=None):
+        self.top_items = TopItems(top_count or self.DEFAULT_TOP_COUNT)
+        self.half_life = half_life
+        self.decay_epoch = time.time()
+        self.decayed_total_cost = 0
+
+    def decay_weight(self, now):
+        # Forward decay: instead of shrinking all old values on every tick, new values
+        # are weighted up by exp(age / tau). Relative order is preserved, so the
+        # top-k structure never has to be rebuilt.
+        # The exponent is checked before exp() is called, so long stretches without
+        # input are fine on every path, including the redraw of an idle display.
+        if not self.half_life:
+            return 1.0
+        if self.decay_exponent(now) > self.MAX_DECAY_EXPONENT:
+            self.renormalize(now)
+        return math.exp(self.decay_exponent(now))
+
+    def decay_exponent(self, now):
+        return (now - self.decay_epoch) * math.log(2) / self.half_life
+
+    def renormalize(self, now):
+        # exp(-x) underflows to zero instead of overflowing, which is the right limit for long idle times
+        factor = math.exp(-self.decay_exponent(now))
+        for cost_info in self.data.values():
+            cost_info.count *= factor
+            cost_info.total_cost *= factor
+        self.decayed_total_cost *= factor
+        self.decay_epoch = now
+
+    def update_for_item_and_cost(self, item_identifier, cost):
+        weight = 1.0
+        if self.half_life:
+            weight = self.decay_weight(time.time())
+        cost_info = self.data[item_identifier]
+        cost_info.count += weight
+        cost_info.total_cost += cost * weight
+        self.decayed_total_cost += cost * weight
+        self.top_items.update(item_identifier, cost_info)
+
+    def current_top_items(self):
+        # Copies scaled back to the present time, rendered with the regular histogram code
+        factor = 1.0 / self.decay_weight(time.time())
+        items = []
+        for item, cost_info in self.top_items.sorted_items():
+            scaled_info = CostInfo()
+            scaled_info.count = int(round(cost_info.count * factor))
+            scaled_info.total_cost = round(cost_info.total_cost * factor)
+            items.append((item, scaled_info))
+        return items, self.decayed_total_cost * factor
+
+    def print_live_histogram(self):
+        items, total_cost = self.current_top_items()
+        sys.stdout.write('\033[H\033[2J')
+        print '{} total item(s), {:.0f} total cost, {} distinct, updated {}'.format(self.total_count, self.total_cost, len(self.data), time.strftime('%H:%M:%S'))
+        if items and total_cost:
+            self.print_items(items, total_cost)
+        sys.stdout.flush()
 
-            def __init__(self):
-                self.count = 0
-                self.total_cost = 0
-                self.item_counter = collections.Counter()
-            
-            def update(self, cost, item):
-                self.count += 1
-                self.total_cost += cost
-                self.item_counter.update([item])
 
+class BucketCounter(BaseCounter):
+
+    # Costs of zero or less have no power-of-two bucket, they are collected under this key
+    ZERO_COST_BUCKET = None
+    QUANTILES = (0.5, 0.9, 0.99, 0.999)
+    DEFAULT_QUANTILE_ITEM_COUNT = 10
+
+    def setup_data(self):
         self.zero_bucket = BucketCostInfo()    
         self.data = collections.defaultdict(BucketCostInfo)
+        self.sketch = QuantileSketch()
+        self.item_sketches = collections.defaultdict(QuantileSketch)
+        self.quantile_item_count = self.DEFAULT_QUANTILE_ITEM_COUNT
 
     def update_for_item_and_cost(self, item_identifier, cost):
-        bucket_id = int(math.ceil(math.log(cost, 2)))
+        if cost > 0:
+            bucket_id = int(math.ceil(math.log(cost, 2)))
+        else:
+            bucket_id = self.ZERO_COST_BUCKET
         self.data[bucket_id].update(cost, item_identifier)
+        self.sketch.add(cost)
+        self.item_sketches[item_identifier].add(cost)
+
+    def merge(self, other):
+        super(BucketCounter, self).merge(other)
+        self.sketch.merge(other.sketch)
+        for item, sketch in other.item_sketches.items():
+            self.item_sketches[item].merge(sketch)
+
+    def snapshot_state(self):
+        state = super(BucketCounter, self).snapshot_state()
+        state['sketch'] = self.sketch.snapshot_state()
+        state['item_sketches'] = dict([(item, sketch.snapshot_state()) for item, sketch in self.item_sketches.items()])
+        return state
+
+    def merge_snapshot_state(self, state):
+        super(BucketCounter, self).merge_snapshot_state(state)
+        self.sketch.merge(QuantileSketch.from_snapshot_state(state['sketch']))
+        for item, sketch_state in state['item_sketches'].items():
+            self.item_sketches[item].merge(QuantileSketch.from_snapshot_state(sketch_state))
 
     def sorted_buckets(self):
-        return sorted(self.data.items(), cmp=lambda a, b: cmp(b[0], a[0]))
+        return sorted([i for i in self.data.items() if i[0] != self.ZERO_COST_BUCKET], cmp=lambda a, b: cmp(b[0], a[0]))
 
-    def print_histogram(self):
+    def bucket_ids_and_labels(self):
+        bucket_ids_and_labels = []
+        if self.ZERO_COST_BUCKET in self.data:
+            bucket_ids_and_labels.append((self.ZERO_COST_BUCKET, 0))
         sorted_buckets = self.sorted_buckets()
-        min_bucket, max_bucket = sorted_buckets[-1][0], sorted_buckets[0][0]
+        if sorted_buckets:
+            min_bucket, max_bucket = sorted_buckets[-1][0], sorted_buckets[0][0]
+            bucket_ids_and_labels.extend([(i, 2 ** i) for i in range(min_bucket, max_bucket + 1)])
+        return bucket_ids_and_labels
+
+    def print_histogram(self):
+        bucket_ids_and_labels = self.bucket_ids_and_labels()
         max_count = max(self.data.values(), key=lambda x: x.count).count
         
-        max_bucket_label_len = len(str(2 ** max_bucket))
+        max_bucket_label_len = max([len(str(label)) for _, label in bucket_ids_and_labels])
 
         terminal_width = self.terminal_width()
         item_width = max_bucket_label_len
         max_bar_length = min(terminal_width - (item_width + 16), 60)
         scale = float(max_bar_length) / max_count
 
-        for i in range(min_bucket, max_bucket + 1):
+        for i, label in bucket_ids_and_labels:
             bucket = self.data.get(i, self.zero_bucket)
             bar_length = int(scale * bucket.count)
             percentage = float(bucket.count) * 100 / self.total_count
-            print '{:{width}}  {:5}  {:>4.1f}% {}'.format(2 ** i, bucket.count, percentage, '*' * bar_length, width=item_width)
+            print '{:{width}}  {:5}  {:>4.1f}% {}'.format(label, bucket.count, percentage, '*' * bar_length, width=item_width)
+
+        self.print_quantiles()
 
         if not self.dump_buckets:
             return
 
-        for i in range(min_bucket, max_bucket + 1):
+        for i, label in bucket_ids_and_labels:
             bucket = self.data.get(i, self.zero_bucket)
             if not bucket.count:
                 continue
             bar_length = int(scale * bucket.count)
             percentage = int(bucket.count * 100 / self.total_count)
-            print '{:<{max_bucket_label_len}} {:>3}% {}'.format(2 ** i, percentage, '*' * bar_length, max_bucket_label_len=max_bucket_label_len)
+            print '{:<{max_bucket_label_len}} {:>3}% {}'.format(label, percentage, '*' * bar_length, max_bucket_label_len=max_bucket_label_len)
             for item, count in bucket.item_counter.most_common(10):
                 print '{:4} {}'.format(count, item.strip())
             print
 
+    def print_quantiles(self):
+        top_items = heapq.nlargest(self.quantile_item_count, self.item_sketches.items(), key=lambda x: x[1].count)
+        rows = [('(all items)', self.sketch)] + [(self.item_label(item), sketch) for item, sketch in top_items]
+        item_width = min(max([len(label) for label, _ in rows]), self.terminal_width() / 2)
+        labels = ['p{:g}'.format(q * 100) for q in self.QUANTILES]
+
+        print
+        print 'Cost quantiles, accurate to within {:g}%:'.format(QuantileSketch.RELATIVE_ACCURACY * 100)
+        print '{:{width}}  {:>7}'.format('', 'count', width=item_width) + ''.join(['  {:>10}'.format(label) for label in labels])
+        for label, sketch in rows:
+            values = ['  {:>10.4g}'.format(sketch.quantile(q)) for q in self.QUANTILES]
+            print '{:{width}}  {:7}'.format(label[:item_width], sketch.count, width=item_width) + ''.join(values)
+
+
+# A contiguous byte range of an input file. The range boundaries are aligned to
+# line starts lazily when the shard is read, so shards can be computed from the
+# file size alone and no line is counted twice or split between two shards.
+class InputShard(object):
+
+    STDIN_PATH = '-'
+    READ_BUFFER_SIZE = 1024 * 1024
+    # Compressed inputs are recognized by their magic bytes, not by their file name
+    DECOMPRESSION_COMMANDS = [
+        ('\x1f\x8b', ['gzip', '-dc']),
+        ('BZh', ['bzip2', '-dc']),
+        ('\xfd7zXZ\x00', ['xz', '-dc']),
+    ]
+
+    def __init__(self, path, start=0, end=None):
+        self.path = path
+        self.start = start
+        self.end = end
+
+    def lines(self):
+        if self.path == self.STDIN_PATH:
+            for line in sys.stdin:
+                yield line
+            return
+
+        decompression_command = self.decompression_command(self.path)
+        if decompression_command:
+            for line in self.decompressed_lines(decompression_command):
+                yield line
+            return
+
+        with open(self.path, 'rb', self.READ_BUFFER_SIZE) as f:
+            position = 0
+            if self.start:
+                # Skip the remainder of the line that straddles the start offset, the previous shard owns it
+                f.seek(self.start - 1)
+                position = self.start - 1 + len(f.readline())
+            for line in f:
+                if self.end is not None and position >= self.end:
+                    break
+                position += len(line)
+                yield line
+
+    def decompressed_lines(self, decompression_command):
+        # The decompressor runs as a separate process, so decompression overlaps with counting
+        cmd = decompression_command + [self.path]
+        logging.debug('Decompressing with {}'.format(cmd))
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=self.READ_BUFFER_SIZE)
+        try:
+            for line in process.stdout:
+                yield line
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+        if returncode:
+            raise Exception('Decompression command {} failed with exit status {}'.format(cmd, returncode))
+
+    @classmethod
+    def is_regular_file(cls, path):
+        # Pipes, FIFOs and /dev/fd/N paths can be read only once, front to back
+        return path != cls.STDIN_PATH and os.path.isfile(path)
+
+    @classmethod
+    def decompression_command(cls, path):
+        # Only regular files are sniffed, reading the magic bytes would consume them from a pipe
+        if not cls.is_regular_file(path):
+            return None
+        with open(path, 'rb') as f:
+            header = f.read(6)
+        for magic, cmd in cls.DECOMPRESSION_COMMANDS:
+            if header.startswith(magic):
+                return cmd
+        return None
+
+    def __repr__(self):
+        return '<InputShard {} {}-{}>'.format(self.path, self.start, self.end)
+
+    @classmethod
+    def shards_for_path(cls, path, shard_size):
+        if not cls.is_regular_file(path) or not shard_size or cls.decompression_command(path):
+            # Pipes and compressed streams cannot be split at byte offsets, each one is a single shard
+            return [cls(path)]
+        size = os.path.getsize(path)
+        if size <= shard_size:
+            return [cls(path)]
+        return [cls(path, start, min(start + shard_size, size)) for start in range(0, size, shard_size)]
+
+
+def count_shard(task):
+    # Pool worker entry point, must be a module-level function so it can be pickled
+    counter_class, counter_arguments, shard = task
+    counter = counter_class(*counter_arguments)
+    counter.update(shard.lines())
+    logging.debug('Counted {} items in {}'.format(counter.total_count, shard))
+    return counter
+
 
 class Tool(object):
 
+    MIN_SHARD_SIZE = 16 * 1024 * 1024
+
     def __init__(self, args):
         self.args = args
         if self.args.cost_distribution:
-            counter_class = BucketCounter
+            self.counter_class = BucketCounter
+        elif self.args.live:
+            self.counter_class = LiveCounter
+        elif self.args.time_buckets:
+            self.counter_class = TimeSeriesCounter
+        elif self.args.group:
+            self.counter_class = TreeCounter
         else:
-            counter_class = DefaultCounter
-        self.counter = counter_class(self.args.item_regex, self.args.cost_regex, self.args.cost_scale, self.args.expand_tabs)
+            self.counter_class = DefaultCounter
+        self.counter_arguments = (self.args.item_regex, self.args.cost_regex, self.args.cost_scale, self.args.expand_tabs, self.extractor())
+        self.counter = self.counter_class(*self.counter_arguments)
         if self.args.cost_distribution:
             self.counter.dump_buckets = self.args.dump_buckets
+            if self.args.top:
+                self.counter.quantile_item_count = self.args.top
+        if self.args.live:
+            self.counter.setup_live(self.args.top, self.args.half_life)
+        if self.args.time_buckets:
+            self.counter.bucket_seconds = self.args.time_buckets
+        if self.args.top and not self.args.cost_distribution:
+            self.counter.top_count = self.args.top
+        if self.args.group:
+            self.counter.level_names = self.counter.extractor.key_group_names()
+
+    def extractor(self, extractor_class=None):
+        if self.args.item_field or self.args.cost_field:
+            extractor = FieldExtractor(self.args.field_separator, self.args.item_field, self.args.cost_field, key_groups=self.args.group)
+        elif self.args.group:
+            extractor = RegexExtractor(self.args.item_regex, self.args.cost_regex, key_groups=True)
+        else:
+            extractor = (extractor_class or RegexExtractor)(self.args.item_regex, self.args.cost_regex)
+        if self.args.time_buckets:
+            timestamp_parser = TimestampParser(self.args.time_format, self.args.time_column)
+            extractor = TimeBucketExtractor(extractor, timestamp_parser, self.args.time_buckets)
+        return extractor
+
+    def run_benchmark(self):
+        lines = []
+        for path in self.input_paths():
+            lines.extend(InputShard(path).lines())
+        if not lines:
+            return
+
+        extractors = [('findall', self.extractor(FindallExtractor)), ('search', self.extractor(RegexExtractor))]
+        if self.args.item_field or self.args.cost_field:
+            extractors = [('fields', self.extractor())]
+        for name, extractor in extractors:
+            # Best of a few runs to filter out scheduling noise
+            elapsed = None
+            for i in range(3):
+                counter = self.counter_class(self.args.item_regex, self.args.cost_regex, self.args.cost_scale, self.args.expand_tabs, extractor)
+                start = time.time()
+                counter.update(lines)
+                run_time = time.time() - start
+                elapsed = min(elapsed, run_time) if elapsed is not None else run_time
+            print '{:8} {:12.0f} lines/s ({} lines in {:.3f}s, {} items)'.format(name, len(lines) / elapsed, len(lines), elapsed, counter.total_count)
+
+    def input_paths(self):
+        if self.args.input_files:
+            return self.args.input_files
+        if self.args.load_snapshot:
+            # Only merging existing snapshots
+            return []
+        return [InputShard.STDIN_PATH]
+
+    def shard_size(self, paths):
+        # Aim for a few shards per worker so that uneven line densities still balance out
+        total_size = sum([os.path.getsize(path) for path in paths if InputShard.is_regular_file(path) and not InputShard.decompression_command(path)])
+        return max(self.MIN_SHARD_SIZE, total_size / (self.args.jobs * 4) + 1)
+
+    def count_serially(self, paths):
+        for path in paths:
+            self.counter.update(InputShard(path).lines())
+
+    def count_in_parallel(self, paths):
+        shard_size = self.shard_size(paths)
+        shards = []
+        for path in paths:
+            shards.extend(InputShard.shards_for_path(path, shard_size))
+        # stdin and pipes are counted in this process like stdin, a worker could not reopen them
+        local_shards = [shard for shard in shards if not InputShard.is_regular_file(shard.path)]
+        tasks = [(self.counter_class, self.counter_arguments, shard) for shard in shards if shard not in local_shards]
+        logging.debug('Counting {} shard(s) with {} worker process(es)'.format(len(tasks), self.args.jobs))
+
+        pool = multiprocessing.Pool(self.args.jobs)
+        try:
+            # imap preserves the shard order, so the merged totals do not depend on scheduling
+            partial_counters = pool.imap(count_shard, tasks)
+            for shard in local_shards:
+                self.counter.update(shard.lines())
+            for partial_counter in partial_counters:
+                self.counter.merge(partial_counter)
+        finally:
+            pool.close()
+            pool.join()
+
+    def run_live(self):
+        # A reader thread feeds the counter while the main thread redraws on a fixed
+        # interval, so redraws happen even when the input stalls
+        lock = threading.Lock()
+
+        def read_lines():
+            # readline() instead of file iteration, which would block on its read-ahead buffer
+            for line in iter(sys.stdin.readline, ''):
+                with lock:
+                    self.counter.update([line])
+
+        reader = threading.Thread(target=read_lines)
+        reader.daemon = True
+        reader.start()
+        try:
+            while reader.is_alive():
+                reader.join(self.args.refresh_interval)
+                with lock:
+                    self.counter.print_live_histogram()
+        except KeyboardInterrupt:
+            pass
 
     def run(self):
-        for input_file in self.args.input_files:
-            self.counter.update(input_file)
+        if self.args.benchmark:
+            self.run_benchmark()
+            return
+
+        if self.args.live:
+            self.run_live()
+            return
+
+        for snapshot_path in self.args.load_snapshot:
+            logging.debug('Merging snapshot {}'.format(snapshot_path))
+            self.counter.merge_snapshot(snapshot_path)
+
+        paths = self.input_paths()
+        if self.args.jobs > 1:
+            self.count_in_parallel(paths)
+        else:
+            self.count_serially(paths)
+
+        if self.args.save_snapshot:
+            self.counter.save_snapshot(self.args.save_snapshot)
+        if self.args.quiet:
+            return
+
         print '{} total item(s), {:.0f} total cost'.format(self.counter.total_count, self.counter.total_cost)
         if not self.counter.total_count:
             return
@@ -192,18 +1212,49 @@ class Tool(object):
     @classmethod
     def main(cls):
         parser = argparse.ArgumentParser(description='Print histogram of frequency of input lines')
-        parser.add_argument('input_files', nargs='*', type=argparse.FileType('r'), default=[sys.stdin], help='Input file paths, defaults to stdin')
+        parser.add_argument('input_files', nargs='*', help='Input file paths, defaults to stdin. Use "-" to read stdin explicitly. Files compressed with gzip, bzip2 or xz are decompressed transparently.')
         parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose debug logging')
         parser.add_argument('-i', '--item-regex', type=re.compile, help='Optional regular expression to select part of each input line for counting purposes')
         parser.add_argument('-c', '--cost-regex', type=re.compile, help='Optional regular expression to select a cost value in each input line')
+        parser.add_argument('-F', '--field-separator', help='Field separator for --item-field and --cost-field, defaults to runs of whitespace')
+        parser.add_argument('-f', '--item-field', type=FieldExtractor.field_list, help='Select the item by 1-based field number(s) instead of a regex, e.g. "3" or "1,4". Multiple fields are joined with the separator.')
+        parser.add_argument('-k', '--cost-field', type=int, help='Select the cost value by 1-based field number instead of a regex')
         parser.add_argument('-s', '--cost-scale', type=float, help='Optional cost scale coefficient')
         parser.add_argument('-t', '--expand-tabs', type=int, default=4, help='Optional tab expansion column width. A value of 0 means do not expand tabs. Default is 4.')
         parser.add_argument('-d', '--cost-distribution', action='store_true', help='Plot and order by the distribution of the cost values')
         parser.add_argument('-b', '--dump-buckets', action='store_true', help='When using the --cost-distribution option, also dump the top items in each bucket')
+        parser.add_argument('-S', '--save-snapshot', metavar='PATH', help='Save the counter state to a snapshot file that can be merged in later runs with --load-snapshot')
+        parser.add_argument('-L', '--load-snapshot', metavar='PATH', action='append', default=[], help='Merge the counter state from a snapshot file saved with --save-snapshot. Can be given multiple times. Stdin is not read if snapshots are given without input files.')
+        parser.add_argument('-q', '--quiet', action='store_true', help='Do not print the histogram, useful with --save-snapshot')
+        parser.add_argument('-l', '--live', action='store_true', help='Read stdin incrementally and redraw the top items periodically, for use with "tail -f" or "log stream" pipelines')
+        parser.add_argument('-n', '--top', type=int, help='Number of items to show. The remaining items are summarized in one row. Defaults to all items, or {} in --live and --time-buckets mode. With --cost-distribution, the number of items to report cost quantiles for, default is {}.'.format(LiveCounter.DEFAULT_TOP_COUNT, BucketCounter.DEFAULT_QUANTILE_ITEM_COUNT))
+        parser.add_argument('-r', '--refresh-interval', type=float, default=1.0, help='Redraw interval in seconds for --live mode. Default is 1.')
+        parser.add_argument('--half-life', type=float, help='In --live mode, exponentially decay counts and costs with this half-life in seconds, so the histogram reflects recent input')
+        parser.add_argument('-g', '--group', action='store_true', help='Use the named groups of --item-regex (or all groups if none are named), or the fields of --item-field, as a composite key and print a tree with subtotals for each level')
+        parser.add_argument('-T', '--time-buckets', type=int, metavar='SECONDS', help='Aggregate the cost of each item into time buckets of the given size and print a sparkline per item, based on a timestamp in each line')
+        parser.add_argument('--time-format', default='%Y-%m-%d %H:%M:%S', help='Fixed-width format of the timestamp for --time-buckets. Supports %%Y %%y %%m %%b %%d %%e %%H %%M %%S. Default is "%(default)s".')
+        parser.add_argument('--time-column', type=int, default=0, help='Character offset of the timestamp in each line for --time-buckets. Default is 0.')
+        parser.add_argument('--benchmark', action='store_true', help='Measure line extraction throughput on the input instead of printing a histogram')
+        parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes. Large input files are split into line-aligned shards that are counted in parallel. Use 0 for one worker per CPU core. Default is 1.')
 
         args = parser.parse_args()
         if args.verbose:
             logging.basicConfig(level=logging.DEBUG)
+        if args.time_buckets and (args.cost_distribution or args.live):
+            parser.error('--time-buckets cannot be combined with --cost-distribution or --live')
+        if args.group and (args.cost_distribution or args.live or args.time_buckets or args.benchmark):
+            parser.error('--group cannot be combined with --cost-distribution, --live, --time-buckets or --benchmark')
+        if args.group and not (args.item_regex or args.item_field):
+            parser.error('--group requires --item-regex or --item-field')
+        if args.live and (args.cost_distribution or args.input_files or args.load_snapshot or args.save_snapshot):
+            parser.error('--live reads stdin only and cannot be combined with --cost-distribution, input files or snapshots')
+        if (args.item_field or args.cost_field) and (args.item_regex or args.cost_regex):
+            parser.error('Field-based and regex-based extraction cannot be combined')
+        if args.jobs < 1:
+            args.jobs = multiprocessing.cpu_count()
+        for path in args.input_files:
+            if path != InputShard.STDIN_PATH and (os.path.isdir(path) or not os.access(path, os.R_OK)):
+                parser.error('Input file "{}" does not exist or is not readable'.format(path))
 
         cls(args).run()
 
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+# make_macho_fixtures.py
+#
+# Writes the synthetic Mach-O images used by test_checklibs.py. They only carry
+# the headers and load commands that checklibs.py reads, no code. Rerun this
+# script after changing it and check in the regenerated files.
+#
+
+import sys, os, struct
+
+MH_EXECUTE = 0x2
+MH_DYLIB = 0x6
+
+LC_LOAD_DYLIB = 0xc
+LC_ID_DYLIB = 0xd
+LC_UUID = 0x1b
+LC_RPATH = 0x8000001c
+
+CPU_TYPES = {
+    'x86_64': (0x01000007, 3),
+    'arm64': (0x0100000c, 0),
+}
+
+
+def string_command(cmd, string, fields = b''):
+    # dylib_command and rpath_command: cmd, cmdsize, string offset, fields, padded string
+    string = string.encode('ascii') + b'\0'
+    string_offset = 12 + len(fields)
+    size = (string_offset + len(string) + 7) // 8 * 8
+    command = struct.pack('<III', cmd, size, string_offset) + fields + string
+    return command + b'\0' * (size - len(command))
+
+
+def dylib_command(cmd, path):
+    # timestamp, current version, compatibility version
+    return string_command(cmd, path, struct.pack('<III', 2, 0x10000, 0x10000))
+
+
+def thin_image(arch, filetype, install_name = None, rpaths = (), dependencies = ()):
+    commands = []
+    if install_name:
+        commands.append(dylib_command(LC_ID_DYLIB, install_name))
+    for rpath in rpaths:
+        commands.append(string_command(LC_RPATH, rpath))
+    for path in dependencies:
+        commands.append(dylib_command(LC_LOAD_DYLIB, path))
+    # A load command the reader has to skip
+    commands.append(struct.pack('<II', LC_UUID, 24) + b'\x11' * 16)
+    cputype, cpusubtype = CPU_TYPES[arch]
+    header = struct.pack('<IiiIIIII', 0xfeedfacf, cputype, cpusubtype, filetype, len(commands), sum(len(command) for command in commands), 0, 0)
+    return header + b''.join(commands)
+
+
+def fat_image(slices):
+    # Fat headers are big-endian, slices start on 4 KB boundaries
+    alignment = 12
+    header = struct.pack('>II', 0xcafebabe, len(slices))
+    body = b''
+    offset = 1 << alignment
+    for arch, data in slices:
+        cputype, cpusubtype = CPU_TYPES[arch]
+        header += struct.pack('>iiIII', cputype, cpusubtype, offset, len(data), alignment)
+        body += data + b'\0' * (-len(data) % (1 << alignment))
+        offset = (1 << alignment) + len(body)
+    return header + b'\0' * ((1 << alignment) - len(header)) + body
+
+
+def write_file(path, data):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+# A bundle with a fat executable and a thin library it loads through @rpath
+def write_app_bundle(root):
+    contents = os.path.join(root, 'App.app', 'Contents')
+
+    def executable(arch, extra_dependencies = ()):
+        return thin_image(arch, MH_EXECUTE, rpaths = ['@executable_path/../Frameworks'],
+            dependencies = ['@rpath/libA.dylib', '/usr/lib/libSystem.B.dylib', '@rpath/libMissing.dylib'] + list(extra_dependencies))
+    write_file(os.path.join(contents, 'MacOS', 'app'), fat_image([('x86_64', executable('x86_64')), ('arm64', executable('arm64', ['@loader_path/../Frameworks/libArm.dylib']))]))
+    write_file(os.path.join(contents, 'Frameworks', 'libA.dylib'), thin_image('x86_64', MH_DYLIB, '@rpath/libA.dylib', dependencies = ['/usr/lib/libSystem.B.dylib']))
+    write_file(os.path.join(contents, 'Resources', 'readme.txt'), b'Not a Mach-O file\n')
+
+
+# A bundle whose libraries all load each other through @rpath, with the library
+# directory last in a long rpath list, so that resolving them probes many paths
+def write_rpath_bundle(root, library_count = 12):
+    contents = os.path.join(root, 'Rpaths.app', 'Contents')
+    rpaths = ['@executable_path/../Nowhere{0}'.format(i) for i in range(5)] + ['@executable_path/../Frameworks']
+    write_file(os.path.join(contents, 'MacOS', 'rpaths'), thin_image('x86_64', MH_EXECUTE, rpaths = rpaths,
+        dependencies = ['@rpath/lib{0}.dylib'.format(i) for i in range(library_count)]))
+    for i in range(library_count):
+        dependencies = ['@rpath/lib{0}.dylib'.format(j) for j in range(i + 1, min(i + 5, library_count))]
+        write_file(os.path.join(contents, 'Frameworks', 'lib{0}.dylib'.format(i)), thin_image('x86_64', MH_DYLIB, '@rpath/lib{0}.dylib'.format(i), dependencies = dependencies))
+
+
+if __name__ == '__main__':
+    root = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'macho')
+    write_app_bundle(root)
+    write_rpath_bundle(root)
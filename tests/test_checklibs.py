@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#
+# test_checklibs.py
+#
+# Checks checklibs.py against the synthetic images in fixtures/macho, which
+# fixtures/make_macho_fixtures.py generates. Run with the Python 2 interpreter
+# checklibs.py itself uses:
+#
+#     python tests/test_checklibs.py
+#
+
+import sys, os, subprocess, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import checklibs
+from checklibs import MachOReader, AnalysisSession, MachOHeaderError
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'macho')
+APP_PATH = os.path.join(FIXTURES_PATH, 'App.app')
+EXECUTABLE_PATH = os.path.join(APP_PATH, 'Contents', 'MacOS', 'app')
+LIBRARY_PATH = os.path.join(APP_PATH, 'Contents', 'Frameworks', 'libA.dylib')
+RPATH_EXECUTABLE_PATH = os.path.join(FIXTURES_PATH, 'Rpaths.app', 'Contents', 'MacOS', 'rpaths')
+CHECKLIBS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'checklibs.py')
+
+
+class MachOReaderTest(unittest.TestCase):
+
+    def test_thin_image(self):
+        reader = MachOReader(LIBRARY_PATH)
+        self.assertEqual(reader.architectures(), ['x86_64'])
+        info = reader.load_info('x86_64')
+        self.assertEqual(info.header_info['filetype'], checklibs.MachOFile.MH_DYLIB)
+        self.assertEqual(info.install_name, '@rpath/libA.dylib')
+        self.assertEqual(info.rpaths, [])
+        self.assertEqual(info.dependencies, [('LC_LOAD_DYLIB', '/usr/lib/libSystem.B.dylib')])
+        self.assertEqual(reader.load_info('arm64'), None)
+
+    def test_fat_image(self):
+        reader = MachOReader(EXECUTABLE_PATH)
+        self.assertEqual(reader.architectures(), ['x86_64', 'arm64'])
+        infos = reader.load_infos(['arm64', 'x86_64'])
+        for arch in ['x86_64', 'arm64']:
+            self.assertEqual(infos[arch].arch, arch)
+            self.assertEqual(infos[arch].header_info['filetype'], checklibs.MachOFile.MH_EXECUTE)
+            self.assertEqual(infos[arch].install_name, None)
+            self.assertEqual(infos[arch].rpaths, ['@executable_path/../Frameworks'])
+        self.assertEqual([path for _, path in infos['x86_64'].dependencies], ['@rpath/libA.dylib', '/usr/lib/libSystem.B.dylib', '@rpath/libMissing.dylib'])
+        self.assertEqual(infos['arm64'].dependencies[-1], ('LC_LOAD_DYLIB', '@loader_path/../Frameworks/libArm.dylib'))
+
+    def test_find_macho_files(self):
+        self.assertEqual(MachOReader.find_macho_files(APP_PATH), [LIBRARY_PATH, EXECUTABLE_PATH])
+        self.assertFalse(MachOReader.is_macho_file(os.path.join(APP_PATH, 'Contents', 'Resources', 'readme.txt')))
+
+
+class AnalysisSessionTest(unittest.TestCase):
+
+    def analyze(self, arch, path = EXECUTABLE_PATH):
+        session = AnalysisSession(arch)
+        try:
+            session.toplevel_image(path)
+        finally:
+            session.close()
+        return dict((image.image_path.recorded_path or image.image_path.resolved_path, image) for image in session.order)
+
+    def test_resolves_rpath_dependencies(self):
+        images = self.analyze('x86_64')
+        library = images['@rpath/libA.dylib']
+        self.assertEqual(library.image_path.resolved_path, LIBRARY_PATH)
+        self.assertTrue(library.image_path.exists())
+        self.assertEqual(library.image_path.rpath_source.image_path.resolved_path, EXECUTABLE_PATH)
+        self.assertFalse(images['@rpath/libMissing.dylib'].image_path.exists())
+
+    def test_analyzes_each_slice(self):
+        self.assertNotIn('@loader_path/../Frameworks/libArm.dylib', self.analyze('x86_64'))
+        self.assertIn('@loader_path/../Frameworks/libArm.dylib', self.analyze('arm64'))
+
+    def test_missing_slice_raises(self):
+        self.assertRaises(MachOHeaderError, self.analyze, 'arm64', LIBRARY_PATH)
+
+    def test_rpath_probes_are_memoized(self):
+        # Every @rpath lookup in Rpaths.app tries five missing directories before the
+        # right one. Compare the disk lookups with those of a session that stats every probe.
+        class UnmemoizedSession(AnalysisSession):
+            def path_exists(self, path):
+                if not path:
+                    return False
+                self.probe_count += 1
+                return os.path.exists(path)
+
+        def analyze(session_class):
+            stat_paths = []
+            exists = os.path.exists
+            def counting_exists(path):
+                stat_paths.append(path)
+                return exists(path)
+            os.path.exists = counting_exists
+            try:
+                session = session_class('x86_64')
+                session.toplevel_image(RPATH_EXECUTABLE_PATH)
+                session.close()
+            finally:
+                os.path.exists = exists
+            return session, stat_paths
+
+        session, stat_paths = analyze(AnalysisSession)
+        unmemoized_session, unmemoized_stat_paths = analyze(UnmemoizedSession)
+
+        self.assertEqual(session.probe_count, unmemoized_session.probe_count)
+        self.assertEqual(session.stat_count, len(set(stat_paths)))
+        self.assertTrue(len(unmemoized_stat_paths) > 3 * len(stat_paths), (len(unmemoized_stat_paths), len(stat_paths)))
+        self.assertEqual(len(session.order), 13)
+        self.assertTrue(all(image.image_path.exists() for image in session.order))
+        self.assertEqual([repr(image.image_path) for image in session.order], [repr(image.image_path) for image in unmemoized_session.order])
+
+
+class CommandLineTest(unittest.TestCase):
+
+    def run_checklibs(self, *arguments):
+        process = subprocess.Popen([sys.executable, CHECKLIBS_PATH, '--no-cache'] + list(arguments), stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        output, error_output = process.communicate()
+        self.assertEqual(process.returncode, 0, error_output)
+        return output, error_output
+
+    def test_all_architectures_of_bundle(self):
+        # The thin x86_64 library sorts before the fat executable, the architectures still come from all images
+        output, error_output = self.run_checklibs('--arch', 'all', APP_PATH)
+        self.assertIn('Analyzing architectures x86_64, arm64', error_output)
+        self.assertIn('Architecture x86_64:', output)
+        self.assertIn('Architecture arm64:', output)
+        self.assertIn('Architecture differences (x86_64, arm64)', output)
+
+    def test_default_architecture_of_bundle(self):
+        output, error_output = self.run_checklibs(APP_PATH)
+        self.assertIn('Analyzing architecture x86_64', error_output)
+        # The executable is walked first
+        self.assertIn(EXECUTABLE_PATH, output.splitlines()[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+#
+# test_toolbox.py
+#
+# Checks parts of toolbox.py that must work without network access. Server
+# interaction is tested against a stub server on localhost.
+#
+#     python3 tests/test_toolbox.py
+#
+
+import sys
+import os
+import socket
+import threading
+import tempfile
+import shutil
+import time
+import re
+import json
+import hashlib
+import urllib.error
+import http.server
+import unittest
+import unittest.mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import toolbox
+
+
+class NetworkAccessError(AssertionError):
+    pass
+
+
+class RaisingSocket(socket.socket):
+
+    def __init__(self, *args, **kwargs):
+        raise NetworkAccessError('Socket opened')
+
+
+def raising_getaddrinfo(*args, **kwargs):
+    raise NetworkAccessError('Host name looked up: {}'.format(args[0] if args else kwargs))
+
+
+class StubServer(object):
+    """
+    HTTP server on a free localhost port. Records each request and answers it with
+    respond(request), which returns a (status, headers, body) tuple.
+    """
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                request = dict(method=self.command, path=self.path, headers=self.headers, body=self.rfile.read(length))
+                stub.requests.append(request)
+                status, headers, body = stub.respond(request)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_POST = do_GET
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class HTTPCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_path)
+        self.server = StubServer(self.respond)
+        self.addCleanup(self.server.close)
+        self.url = self.server.url + '/page'
+
+    def respond(self, request):
+        if request['headers'].get('If-None-Match') == '"v1"':
+            return 304, {}, b''
+        return 200, {'ETag': '"v1"'}, b'body v1'
+
+    def test_fresh_entry_is_used_without_request(self):
+        cache = toolbox.HTTPCache(self.cache_path, ttl=600)
+        self.assertEqual(cache.fetch(self.url, toolbox.HTTPClient.urlopen), b'body v1')
+        self.assertEqual(cache.fetch(self.url, toolbox.HTTPClient.urlopen), b'body v1')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_stale_entry_is_revalidated(self):
+        cache = toolbox.HTTPCache(self.cache_path, ttl=0)
+        self.assertEqual(cache.fetch(self.url, toolbox.HTTPClient.urlopen), b'body v1')
+        fetched = cache.load_entry(self.url)[0]['fetched']
+        time.sleep(0.01)
+        self.assertEqual(cache.fetch(self.url, toolbox.HTTPClient.urlopen), b'body v1')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.requests[1]['headers'].get('If-None-Match'), '"v1"')
+        # The 304 response refreshes the entry
+        self.assertTrue(cache.load_entry(self.url)[0]['fetched'] > fetched)
+
+    def test_stale_entry_is_used_when_server_is_down(self):
+        cache = toolbox.HTTPCache(self.cache_path, ttl=0)
+        cache.fetch(self.url, toolbox.HTTPClient.urlopen)
+        self.server.close()
+        with unittest.mock.patch('sys.stderr'):
+            self.assertEqual(cache.fetch(self.url, toolbox.HTTPClient.urlopen), b'body v1')
+
+    def test_missing_entry_raises_when_server_is_down(self):
+        cache = toolbox.HTTPCache(self.cache_path, ttl=600)
+        self.server.close()
+        with self.assertRaises(urllib.error.URLError):
+            cache.fetch(self.url, toolbox.HTTPClient.urlopen)
+
+
+class DownloadCacheTest(unittest.TestCase):
+
+    content = b'current archive'
+
+    def setUp(self):
+        self.cache_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_path)
+        self.server = StubServer(self.respond)
+        self.addCleanup(self.server.close)
+        self.url = self.server.url + '/archive.tar.gz'
+        self.cache = toolbox.DownloadCache(self.cache_path)
+
+    def respond(self, request):
+        range_header = request['headers'].get('Range')
+        if not range_header:
+            return 200, {}, self.content
+        offset = int(re.match(r'bytes=(\d+)-$', range_header).group(1))
+        if offset >= len(self.content):
+            return 416, {}, b''
+        return 206, {}, self.content[offset:]
+
+    def write_partial_file(self, content):
+        partial_path = os.path.join(self.cache_path, 'partial', hashlib.sha256(self.url.encode('utf-8')).hexdigest() + '.part')
+        with open(partial_path, 'wb') as f:
+            f.write(content)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_resumes_partial_download(self):
+        self.write_partial_file(self.content[:5])
+        path = self.cache.download(self.url, toolbox.HTTPClient.urlopen)
+        self.assertEqual(self.read(path), self.content)
+        self.assertEqual(self.server.requests[0]['headers'].get('Range'), 'bytes=5-')
+        # Cached for the URL from now on
+        self.assertEqual(self.cache.download(self.url, toolbox.HTTPClient.urlopen), path)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_unverifiable_partial_file_is_downloaded_again(self):
+        # Left over from a longer file that has since been replaced at the same URL
+        self.write_partial_file(b'previous, longer archive')
+        path = self.cache.download(self.url, toolbox.HTTPClient.urlopen)
+        self.assertEqual(self.read(path), self.content)
+        self.assertEqual([request['headers'].get('Range') for request in self.server.requests], ['bytes=24-', None])
+
+    def test_verified_complete_partial_file_is_used(self):
+        self.write_partial_file(self.content)
+        path = self.cache.download(self.url, toolbox.HTTPClient.urlopen, hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(self.read(path), self.content)
+        self.assertEqual(len(self.server.requests), 1)
+
+
+class GitHubReleaseBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer(self.respond)
+        self.addCleanup(self.server.close)
+        cache_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_path)
+        patches = [
+            # GitHubRelease reads GITHUB_API_URL and GITHUB_GRAPHQL_URL into these when toolbox.py is loaded
+            unittest.mock.patch.object(toolbox.GitHubRelease, 'api_base_url', self.server.url),
+            unittest.mock.patch.object(toolbox.GitHubRelease, 'graphql_url', self.server.url + '/graphql'),
+            unittest.mock.patch.object(toolbox.HTTPClient, 'cache', toolbox.HTTPCache(cache_path, ttl=600)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def respond(self, request):
+        if request['method'] != 'POST' or request['path'] != '/graphql':
+            return 404, {}, b''
+        query = json.loads(request['body'].decode('utf-8'))['query']
+        data = {}
+        for alias, owner, name in re.findall(r'(r\d+): repository\(owner: "([^"]+)", name: "([^"]+)"\)', query):
+            assets = [dict(name='{}-9.8.7.tar.gz'.format(name), downloadUrl='https://example.com/{}/{}.tar.gz'.format(owner, name))]
+            data[alias] = dict(latestRelease=dict(name='{} v9.8.7'.format(name), tagName='v9.8.7', releaseAssets=dict(nodes=assets)))
+        return 200, {'Content-Type': 'application/json'}, json.dumps(dict(data=data)).encode('utf-8')
+
+    def manifest_tools(self):
+        return [toolbox.Tool.tool_for_identifier(entry['identifier']) for entry in toolbox.GITHUB_TOOL_MANIFEST]
+
+    def test_one_query_for_all_releases(self):
+        tools = self.manifest_tools()
+        toolbox.GitHubRelease.load_latest_releases([tool.release for tool in tools], 'token')
+
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.server.requests[0]['headers'].get('Authorization'), 'bearer token')
+        for tool in tools:
+            project, repository = tool.manifest['repo'].split('/')
+            self.assertEqual(tool.release.cached_server_data, dict(name='{} v9.8.7'.format(repository), tag_name='v9.8.7',
+                assets=[dict(name='{}-9.8.7.tar.gz'.format(repository), browser_download_url='https://example.com/{}/{}.tar.gz'.format(project, repository))]))
+            self.assertEqual(str(tool.latest_version()), '9.8.7')
+
+    def test_results_are_cached(self):
+        releases = [tool.release for tool in self.manifest_tools()]
+        toolbox.GitHubRelease.load_latest_releases(releases, 'token')
+
+        # Fresh tools get their releases from the HTTP cache, batched or one by one
+        cached_releases = [tool.release for tool in self.manifest_tools()]
+        toolbox.GitHubRelease.load_latest_releases(cached_releases, 'token')
+        self.assertEqual([release.cached_server_data for release in cached_releases], [release.cached_server_data for release in releases])
+        for tool in self.manifest_tools():
+            self.assertEqual(str(tool.latest_version()), '9.8.7')
+        self.assertEqual(len(self.server.requests), 1)
+
+
+class EnumerationTest(unittest.TestCase):
+
+    def setUp(self):
+        patches = [
+            unittest.mock.patch('socket.socket', RaisingSocket),
+            unittest.mock.patch('socket.getaddrinfo', raising_getaddrinfo),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_patch_catches_requests(self):
+        with self.assertRaises(NetworkAccessError):
+            toolbox.HTTPClient.urlopen('https://example.com/')
+
+    def test_enumeration_opens_no_sockets(self):
+        identifiers = toolbox.Tool.known_identifiers()
+        self.assertTrue({'python3', 'node', 'exiftool', 'hugo'} <= set(identifiers), identifiers)
+        for identifier in identifiers:
+            tool = toolbox.Tool.tool_for_identifier(identifier)
+            self.assertEqual(tool.identifier(), identifier)
+            tool.is_installed()
+        for identifier, tool in toolbox.Tool.enumerate_installed_tools():
+            tool.installed_version()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,12 +8,298 @@ import logging
 import subprocess
 import pkg_resources
 import urllib.request
+import urllib.error
+import urllib.parse
 import json
 import tarfile
 import zipfile
+import tempfile
+import io
 import shutil
 import glob
 import contextlib
+import concurrent.futures
+import hashlib
+import time
+import threading
+
+
+class HTTPCache(object):
+    """
+    Persistent cache of response bodies. Entries younger than the TTL are used without
+    a request, older ones are revalidated with their ETag and Last-Modified values.
+    If the server can't be reached, a stale entry is used instead.
+    """
+
+    def __init__(self, path=None, ttl=600):
+        self.path = path or self.default_path()
+        self.ttl = ttl
+        os.makedirs(self.path, exist_ok=True)
+
+    @classmethod
+    def default_path(cls):
+        caches_path = os.path.expanduser('~/Library/Caches')
+        if not os.path.isdir(caches_path):
+            caches_path = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+        return os.path.join(caches_path, 'toolbox.py', 'http')
+
+    def entry_path(self, url):
+        return os.path.join(self.path, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def load_entry(self, url):
+        entry_path = self.entry_path(url)
+        try:
+            with open(entry_path + '.json') as f:
+                entry = json.load(f)
+            with open(entry_path + '.body', 'rb') as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None, None
+        return entry, body
+
+    def store_entry(self, url, entry, body=None):
+        # Write to temporary files first so concurrent readers never see a partial entry
+        entry_path = self.entry_path(url)
+        suffix = '.{}.tmp'.format(os.getpid())
+        if body is not None:
+            with open(entry_path + '.body' + suffix, 'wb') as f:
+                f.write(body)
+            os.replace(entry_path + '.body' + suffix, entry_path + '.body')
+        with open(entry_path + '.json' + suffix, 'w') as f:
+            json.dump(entry, f)
+        os.replace(entry_path + '.json' + suffix, entry_path + '.json')
+
+    def is_fresh(self, entry):
+        return entry and time.time() - entry['fetched'] < self.ttl
+
+    def fresh_body(self, url):
+        # The cached body if it can be used without a request, otherwise None
+        entry, body = self.load_entry(url)
+        if self.is_fresh(entry):
+            return body
+        return None
+
+    def store_body(self, url, body):
+        # Stores a body that was obtained some other way, it has nothing to revalidate with
+        self.store_entry(url, dict(url=url, fetched=time.time(), etag=None, last_modified=None), body)
+
+    def fetch(self, url, urlopen):
+        entry, body = self.load_entry(url)
+        if self.is_fresh(entry):
+            logging.debug('Using cached response for {}'.format(url))
+            return body
+
+        request = urllib.request.Request(url)
+        if entry and entry.get('etag'):
+            request.add_header('If-None-Match', entry['etag'])
+        if entry and entry.get('last_modified'):
+            request.add_header('If-Modified-Since', entry['last_modified'])
+        try:
+            response = urlopen(request)
+            body = response.read()
+            entry = dict(url=url, fetched=time.time(), etag=response.headers.get('ETag'), last_modified=response.headers.get('Last-Modified'))
+            self.store_entry(url, entry, body)
+            return body
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and entry:
+                logging.debug('Cached response for {} is still current'.format(url))
+                entry['fetched'] = time.time()
+                self.store_entry(url, entry)
+                return body
+            if not entry:
+                raise
+            print('Using cached response for {} from {}, the server returned an error: {}'.format(url, time.ctime(entry['fetched']), e), file=sys.stderr)
+            return body
+        except (urllib.error.URLError, OSError) as e:
+            if not entry:
+                raise
+            print('Using cached response for {} from {}, the server is unreachable: {}'.format(url, time.ctime(entry['fetched']), e), file=sys.stderr)
+            return body
+
+
+class DownloadCache(object):
+    """
+    Content-addressed store of downloaded files. Each file is stored under its SHA-256
+    digest and an index maps URLs to digests, so downloading the same URL again doesn't
+    touch the network. Interrupted downloads are resumed from their partial file with
+    an HTTP range request.
+    """
+
+    chunk_size = 1024 * 1024
+
+    def __init__(self, path=None):
+        self.path = path or self.default_path()
+        for name in ['objects', 'urls', 'partial']:
+            os.makedirs(os.path.join(self.path, name), exist_ok=True)
+
+    @classmethod
+    def default_path(cls):
+        return os.path.join(os.path.dirname(HTTPCache.default_path()), 'downloads')
+
+    @classmethod
+    def sha256_for_path(cls, path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(cls.chunk_size), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def object_path(self, sha256, name):
+        # The file keeps its name, some installers look at the extension
+        return os.path.join(self.path, 'objects', sha256, name)
+
+    def index_path(self, url):
+        return os.path.join(self.path, 'urls', hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+    def cached_path(self, url, sha256=None):
+        try:
+            with open(self.index_path(url)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if sha256 and entry['sha256'] != sha256:
+            return None
+        path = self.object_path(entry['sha256'], entry['name'])
+        return path if os.path.exists(path) else None
+
+    def download(self, url, urlopen, sha256=None):
+        # Returns the path of the downloaded file, sha256 is the expected digest if it is known
+        path = self.cached_path(url, sha256)
+        if path:
+            logging.debug('Using cached download {} for {}'.format(path, url))
+            return path
+
+        partial_path = os.path.join(self.path, 'partial', hashlib.sha256(url.encode('utf-8')).hexdigest() + '.part')
+        offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+        request = urllib.request.Request(url)
+        if offset:
+            request.add_header('Range', 'bytes={}-'.format(offset))
+        logging.debug('Downloading {} (offset {})'.format(url, offset))
+        response = None
+        try:
+            response = urlopen(request)
+        except urllib.error.HTTPError as e:
+            if e.code != 416:
+                raise
+            e.close()
+            # Range not satisfiable. The partial file is either complete or left over from an
+            # earlier, longer file at the same URL, only the expected checksum tells them apart.
+            if not sha256 or self.sha256_for_path(partial_path) != sha256:
+                logging.debug('Discarding partial download {} of {}, it cannot be verified'.format(partial_path, url))
+                os.remove(partial_path)
+                offset = 0
+                response = urlopen(urllib.request.Request(url))
+        if response:
+            with response:
+                if response.status != 206:
+                    offset = 0
+                with open(partial_path, 'ab' if offset else 'wb') as f:
+                    for chunk in iter(lambda: response.read(self.chunk_size), b''):
+                        f.write(chunk)
+
+        actual_sha256 = self.sha256_for_path(partial_path)
+        if sha256 and actual_sha256 != sha256:
+            os.remove(partial_path)
+            raise Exception('Checksum mismatch for {}: expected {}, got {}'.format(url, sha256, actual_sha256))
+        name = os.path.basename(urllib.parse.urlparse(url).path) or 'download'
+        path = self.object_path(actual_sha256, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(partial_path, path)
+        with open(self.index_path(url), 'w') as f:
+            json.dump(dict(url=url, sha256=actual_sha256, name=name), f)
+        return path
+
+
+class HTTPClient(object):
+
+    # Seconds to wait for a server before giving up on a request
+    timeout = 30
+    # An HTTPCache for fetch(), None to always load from the server
+    cache = None
+    # The DownloadCache for download()
+    download_cache = None
+
+    @classmethod
+    def urlopen(cls, url_or_request):
+        return urllib.request.urlopen(url_or_request, timeout=cls.timeout)
+
+    @classmethod
+    def fetch(cls, url):
+        # Returns the response body for the URL, from the cache if there is one
+        logging.debug('Loading {}'.format(url))
+        if cls.cache:
+            return cls.cache.fetch(url, cls.urlopen)
+        return cls.urlopen(url).read()
+
+    @classmethod
+    def download(cls, url, sha256=None):
+        if not cls.download_cache:
+            cls.download_cache = DownloadCache()
+        return cls.download_cache.download(url, cls.urlopen, sha256)
+
+
+class Profiler(object):
+    """
+    Collects how long each phase takes for each tool when enabled. The phases can run on
+    several threads and overlap. Install includes extract, so the per-tool total leaves
+    extract out.
+    """
+
+    PHASES = ['version probe', 'metadata fetch', 'download', 'extract', 'install']
+    NESTED_PHASES = ['extract']
+
+    enabled = False
+    events = []
+    # Report rows follow this order of tool identifiers, other rows come last in the order they started
+    tool_order = []
+    lock = threading.Lock()
+    start_time = time.perf_counter()
+
+    @classmethod
+    @contextlib.contextmanager
+    def phase(cls, tool_identifier, phase):
+        if not cls.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with cls.lock:
+                cls.events.append(dict(tool=tool_identifier, phase=phase, start=start, duration=end - start, thread=threading.get_ident()))
+
+    @classmethod
+    def timed(cls, tool_identifier, phase, function, *args):
+        with cls.phase(tool_identifier, phase):
+            return function(*args)
+
+    @classmethod
+    def print_report(cls, file=sys.stdout):
+        durations = {}
+        for event in sorted(cls.events, key=lambda event: event['start']):
+            tool_durations = durations.setdefault(event['tool'], {})
+            tool_durations[event['phase']] = tool_durations.get(event['phase'], 0) + event['duration']
+        tool_identifiers = sorted(durations, key=lambda identifier: cls.tool_order.index(identifier) if identifier in cls.tool_order else len(cls.tool_order))
+        columns = ['tool'] + cls.PHASES + ['total']
+        rows = []
+        for tool_identifier in tool_identifiers:
+            tool_durations = durations[tool_identifier]
+            total = sum(duration for phase, duration in tool_durations.items() if phase not in cls.NESTED_PHASES)
+            rows.append([tool_identifier] + ['{:.3f}s'.format(tool_durations[phase]) if phase in tool_durations else '-' for phase in cls.PHASES] + ['{:.3f}s'.format(total)])
+        widths = [max([len(column)] + [len(row[i]) for row in rows]) for i, column in enumerate(columns)]
+        for row in [columns] + rows:
+            print('  '.join([row[0].ljust(widths[0])] + [value.rjust(width) for value, width in zip(row[1:], widths[1:])]), file=file)
+
+    @classmethod
+    def write_trace(cls, path):
+        # Chrome trace event format, viewable in chrome://tracing or Perfetto
+        trace_events = []
+        for event in cls.events:
+            trace_events.append(dict(name=event['phase'], cat=event['tool'], ph='X', pid=os.getpid(), tid=event['thread'],
+                ts=int((event['start'] - cls.start_time) * 1e6), dur=int(event['duration'] * 1e6), args=dict(tool=event['tool'])))
+        with open(path, 'w') as f:
+            json.dump(dict(traceEvents=trace_events, displayTimeUnit='ms'), f)
 
 
 class GitHubReleaseAsset(object):
@@ -41,6 +327,10 @@ class GitHubReleaseAsset(object):
 
 class GitHubRelease(object):
 
+    # The same variables GitHub Actions sets, a local stand-in server can be used instead
+    api_base_url = os.environ.get('GITHUB_API_URL', 'https://api.github.com')
+    graphql_url = os.environ.get('GITHUB_GRAPHQL_URL', api_base_url + '/graphql')
+
     def __init__(self, repository, release, version_number_accessor, preferred_asset_predicate=None):
         self.repository = repository
         self.release = release
@@ -48,13 +338,14 @@ class GitHubRelease(object):
         self.version_number_accessor = version_number_accessor
         self.cached_server_data = None
     
+    def url(self):
+        return '{}/repos/{}/{}/releases/{}'.format(self.api_base_url, self.repository.project, self.repository.repository, self.release)
+
     def server_data(self):
         if not self.cached_server_data:
             try:
-                url = 'https://api.github.com/repos/{}/{}/releases/{}'.format(self.repository.project, self.repository.repository, self.release)
-                logging.debug('Loading {}'.format(url))            
-                result = urllib.request.urlopen(url)
-                self.cached_server_data = json.load(result)
+                url = self.url()
+                self.cached_server_data = json.loads(HTTPClient.fetch(url))
                 assert 'assets' in self.cached_server_data, 'Unexpected data format: {}'.format(self.cached_server_data)
             except Exception as e:
                 print('Unable to open URL {}: {}'.format(url, e), file=sys.stderr)
@@ -66,6 +357,38 @@ class GitHubRelease(object):
             return None
         return pkg_resources.parse_version(self.version_number_accessor(self))
 
+    @classmethod
+    def load_latest_releases(cls, releases, token):
+        # Loads the server data of several 'latest' releases with a single GraphQL query
+        # and converts it to the format of the REST API. Releases with a fresh response
+        # in the HTTP cache are taken from there, the others are added to the cache.
+        cache = HTTPClient.cache
+        if cache:
+            for release in releases:
+                body = cache.fresh_body(release.url())
+                if body:
+                    release.cached_server_data = json.loads(body)
+            releases = [release for release in releases if not release.cached_server_data]
+            if not releases:
+                return
+        fields = []
+        for i, release in enumerate(releases):
+            fields.append('r{}: repository(owner: {}, name: {}) {{ latestRelease {{ name tagName releaseAssets(first: 100) {{ nodes {{ name downloadUrl }} }} }} }}'.format(
+                i, json.dumps(release.repository.project), json.dumps(release.repository.repository)))
+        query = '{{ {} }}'.format(' '.join(fields))
+        request = urllib.request.Request(cls.graphql_url, data=json.dumps(dict(query=query)).encode('utf-8'),
+            headers={'Authorization': 'bearer ' + token, 'Content-Type': 'application/json'})
+        logging.debug('Loading {} releases from {}'.format(len(releases), cls.graphql_url))
+        data = json.load(HTTPClient.urlopen(request))['data']
+        for i, release in enumerate(releases):
+            latest_release = (data.get('r{}'.format(i)) or {}).get('latestRelease')
+            if not latest_release:
+                continue
+            assets = [dict(name=asset['name'], browser_download_url=asset['downloadUrl']) for asset in latest_release['releaseAssets']['nodes']]
+            release.cached_server_data = dict(name=latest_release['name'], tag_name=latest_release['tagName'], assets=assets)
+            if cache:
+                cache.store_body(release.url(), json.dumps(release.cached_server_data).encode('utf-8'))
+
     def server_data_item(self, key):
         data = self.server_data()
         if not data:
@@ -93,6 +416,26 @@ class GitHubRelease(object):
                 logging.warning(f'Zero predicate results for list of {input_asset_count} input assets for predicate {predicate._predicate_description}')
         return assets
 
+    def checksum_for_asset(self, asset):
+        # Many projects publish a SHA-256 sums file for all assets or a .sha256 file per asset
+        hex_digest_regex = r'[0-9a-fA-F]{64}'
+        sums_assets = [a for a in self.assets() if re.search(r'(?i)(sha-?256|checksums)', a.name())]
+        for sums_asset in sums_assets:
+            try:
+                text = HTTPClient.fetch(sums_asset.download_url()).decode('utf-8')
+            except Exception as e:
+                logging.warning('Unable to load checksums from {}: {}'.format(sums_asset.download_url(), e))
+                continue
+            for line in text.splitlines():
+                fields = line.split()
+                if not fields or not re.fullmatch(hex_digest_regex, fields[0]):
+                    continue
+                if len(fields) == 1 and sums_asset.name().startswith(asset.name()):
+                    return fields[0].lower()
+                if len(fields) > 1 and fields[-1].lstrip('*') == asset.name():
+                    return fields[0].lower()
+        return None
+
     def preferred_asset(self):
         assert self.preferred_asset_predicate
         assets = self.assets(predicate=self.preferred_asset_predicate)
@@ -111,14 +454,29 @@ class GitHubRepo(object):
 class Tool(object):
 
     tool_class_map = None
+    # Whether install_archive() can read the archive from a stream instead of a file
+    supports_streamed_install = False
+    # Zip archives read from a stream are kept in memory up to this size, then spooled to disk
+    zip_spool_size = 64 * 1024 * 1024
+    # Parallel jobs for source builds
+    build_jobs = os.cpu_count() or 1
+    # Whether source builds compile through ccache if it is installed
+    use_ccache = False
+    # Environment variables whose values end up in autoconf cache files. configure refuses
+    # a cache written with different values, so there is one cache file per combination.
+    configure_cache_variables = ['CC', 'CXX', 'CPP', 'CXXCPP', 'CFLAGS', 'CXXFLAGS', 'CPPFLAGS', 'LDFLAGS', 'LIBS']
+    # Seconds to wait for a version probe process
+    process_timeout = 30
 
     @classmethod
     def tool_for_identifier(cls, identifier):
         if not cls.tool_class_map:
-            cls.tool_class_map = {}
+            # Tools can be looked up from several threads, only publish the map once it is complete
+            tool_class_map = {}
             for i, subclass in cls.enumerate_known_tool_classes():
-                cls.tool_class_map[i] = subclass
+                tool_class_map[i] = subclass
                 logging.debug('Subclass {} identifier {}'.format(subclass, i))
+            cls.tool_class_map = tool_class_map
         if identifier not in cls.tool_class_map:
             raise Exception('Unable to find tool with identifier "{}"'.format(identifier))
         return cls.tool_class_map[identifier]()
@@ -138,7 +496,7 @@ class Tool(object):
         installed_tools = []
         for i, subclass in cls.enumerate_known_tool_classes():
             tool = subclass()
-            if tool.is_installed:
+            if tool.is_installed():
                 yield i, tool
 
     @classmethod
@@ -171,12 +529,14 @@ class Tool(object):
     def latest_version(self):
         raise Exception('"{}" must override this method'.format(type(self).__name__))
     
-    def is_out_of_date(self):
-        installed_version = self.installed_version()
+    def is_out_of_date(self, versions=None):
+        # versions is an optional (installed version, latest version) tuple checked earlier
+        installed_version, latest_version = versions or (self.installed_version(), None)
         if not installed_version:
             print('Tool {} is not installed. Install it first with the "install" action.'.format(self.identifier()), file=sys.stderr)
             return False
-        latest_version = self.latest_version()
+        if not versions:
+            latest_version = self.latest_version()
         if not latest_version:
             print('Unable to check if {} is current because the latest version is unavailable'.format(self.identifier()), file=sys.stderr)
             return False
@@ -189,18 +549,82 @@ class Tool(object):
         os.mkdir(temp_file_path)
         return temp_file_path
 
+    def build_cache_path(self):
+        # Kept between installs, for example for configure results of earlier versions
+        path = os.path.join(os.path.dirname(HTTPCache.default_path()), 'build', self.identifier())
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def configure_cache_file_path(self, environment):
+        key = '\n'.join('{}={}'.format(name, environment.get(name, '')) for name in self.configure_cache_variables)
+        return os.path.join(self.build_cache_path(), 'config-{}.cache'.format(hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]))
+
+    def ccache_path(self):
+        if not self.use_ccache:
+            return None
+        return shutil.which('ccache')
+
+    def build_from_source(self, source_path, configure_arguments=None):
+        # Builds in a separate directory next to the source tree and installs with sudo.
+        # CMake projects are detected by their CMakeLists.txt, all others use autoconf.
+        build_path = source_path.rstrip('/') + '-build'
+        os.makedirs(build_path, exist_ok=True)
+        configure_arguments = configure_arguments or []
+        ccache_path = self.ccache_path()
+        jobs = str(self.build_jobs)
+        if os.path.exists(os.path.join(source_path, 'CMakeLists.txt')):
+            cmd = ['cmake', '-S', source_path, '-B', build_path, '-DCMAKE_BUILD_TYPE=Release']
+            if ccache_path:
+                cmd += ['-DCMAKE_C_COMPILER_LAUNCHER=' + ccache_path, '-DCMAKE_CXX_COMPILER_LAUNCHER=' + ccache_path]
+            logging.debug('Configure command: {}'.format(cmd + configure_arguments))
+            subprocess.check_call(cmd + configure_arguments)
+            subprocess.check_call(['cmake', '--build', build_path, '--parallel', jobs])
+            subprocess.check_call(['sudo', 'cmake', '--install', build_path])
+        else:
+            environment = dict(os.environ)
+            if ccache_path:
+                environment['CC'] = '{} {}'.format(ccache_path, environment.get('CC', 'cc'))
+                environment['CXX'] = '{} {}'.format(ccache_path, environment.get('CXX', 'c++'))
+            cache_file_path = self.configure_cache_file_path(environment)
+            cmd = [os.path.join(source_path, 'configure'), '--cache-file=' + cache_file_path] + configure_arguments
+            logging.debug('Configure command: {}'.format(cmd))
+            try:
+                subprocess.check_call(cmd, cwd=build_path, env=environment)
+            except subprocess.CalledProcessError:
+                # Cached results can also go stale without the environment changing, for example after a compiler update
+                if not os.path.exists(cache_file_path):
+                    raise
+                logging.warning('configure failed, retrying without the cached results in {}'.format(cache_file_path))
+                os.remove(cache_file_path)
+                subprocess.check_call(cmd, cwd=build_path, env=environment)
+            subprocess.check_call(['make', '-j', jobs], cwd=build_path, env=environment)
+            subprocess.check_call(['sudo', 'make', 'install'], cwd=build_path)
+
+
+    def download_latest_version(self):
+        if not self.latest_version():
+            print('Unable to install {} because the latest version is unavailable'.format(self.identifier()), file=sys.stderr)
+            return None
+        with Profiler.phase(self.identifier(), 'download'):
+            return HTTPClient.download(self.latest_version_archive_url(), self.latest_version_archive_checksum())
 
-    def install_latest_version(self):
+    def stream_latest_version(self):
+        # Installs directly from the download response, without the download cache or checksum verification
         if not self.latest_version():
             print('Unable to install {} because the latest version is unavailable'.format(self.identifier()), file=sys.stderr)
             return False
-        url = self.latest_version_archive_url()
-        head, tail = os.path.split(url)
-        temp_file_path = os.path.join(os.environ['TMPDIR'], tail)
-        cmd = ['curl', '-L', '-o', temp_file_path, url]
-        logging.debug('Download command: {}'.format(cmd))
-        subprocess.check_call(cmd)
-        self.install_archive(temp_file_path)
+        with Profiler.phase(self.identifier(), 'install'), HTTPClient.urlopen(self.latest_version_archive_url()) as response:
+            self.install_archive(response)
+        return True
+
+    def install_latest_version(self, archive_path=None):
+        # archive_path is the result of an earlier download_latest_version() call
+        archive_path = archive_path or self.download_latest_version()
+        if not archive_path:
+            return False
+        with Profiler.phase(self.identifier(), 'install'):
+            self.install_archive(archive_path)
+        return True
     
     @classmethod
     def have_dmgtool(cls):
@@ -221,13 +645,69 @@ class Tool(object):
     def install_archive(self, archive_path):
         raise Exception('"{}" must override this method'.format(type(self).__name__))
 
+    @classmethod
+    def extract_archive(cls, archive, destination, members=None):
+        # Extracts a tar or zip archive, given as a path or a binary stream, in a single pass.
+        # If members is a collection of member names, only those are extracted and reading
+        # stops as soon as all of them were found. Returns the extracted member names.
+        with Profiler.phase(cls.identifier(), 'extract'):
+            if isinstance(archive, str):
+                is_zip = zipfile.is_zipfile(archive)
+            else:
+                if not hasattr(archive, 'peek'):
+                    archive = io.BufferedReader(archive)
+                is_zip = archive.peek(4)[:4] == b'PK\x03\x04'
+            if is_zip:
+                return cls.extract_zip_archive(archive, destination, members)
+            return cls.extract_tar_archive(archive, destination, members)
+
+    @classmethod
+    def extract_tar_archive(cls, archive, destination, members=None):
+        # Stream mode reads each entry once in archive order and never builds the member index
+        remaining = set(members) if members is not None else None
+        extracted = []
+        if isinstance(archive, str):
+            tar = tarfile.open(archive, mode='r|*')
+        else:
+            tar = tarfile.open(fileobj=archive, mode='r|*')
+        with tar:
+            for member in tar:
+                if remaining is not None:
+                    if member.name not in remaining:
+                        continue
+                    remaining.discard(member.name)
+                tar.extract(member, path=destination)
+                extracted.append(member.name)
+                if remaining is not None and not remaining:
+                    break
+        return extracted
+
+    @classmethod
+    def extract_zip_archive(cls, archive, destination, members=None):
+        # The zip directory is at the end of the file, so a stream has to be spooled first
+        with contextlib.ExitStack() as stack:
+            if not isinstance(archive, str):
+                spool = stack.enter_context(tempfile.SpooledTemporaryFile(max_size=cls.zip_spool_size))
+                shutil.copyfileobj(archive, spool)
+                spool.seek(0)
+                archive = spool
+            zip_archive = stack.enter_context(zipfile.ZipFile(archive))
+            extracted = [name for name in zip_archive.namelist() if members is None or name in members]
+            for name in extracted:
+                zip_archive.extract(name, path=destination)
+        return extracted
+
     def latest_version_archive_url(self):
         raise Exception('"{}" must override this method'.format(type(self).__name__))
+
+    def latest_version_archive_checksum(self):
+        # The SHA-256 hex digest of the archive if the tool's publisher provides one
+        return None
     
     @classmethod
     def version_from_process_output(cls, cmd, regex=None):
         try:
-            version_string = subprocess.check_output(cmd, text=True).strip()
+            version_string = subprocess.check_output(cmd, text=True, timeout=cls.process_timeout).strip()
         except Exception as e:
             return None        
         if regex:
@@ -238,99 +718,117 @@ class Tool(object):
 
 
 class GitHubReleaseBasedTool(Tool):
+    """
+    Base class for tools installed from GitHub release assets. The concrete tools are
+    generated from manifest entries, see GITHUB_TOOL_MANIFEST.
+    """
 
-    @classmethod
-    def version_regex(cls):
-        return r'\bv((?:[0-9]|\.)+)\b'
-
-    def latest_version(self):
-        return self.release.version()
-
-    def latest_version_archive_url(self):
-        return self.release.preferred_asset().download_url()
-
-
-class ToolHugo(GitHubReleaseBasedTool):
+    supports_streamed_install = True
+    manifest = None
+    # Tool classes only referenced as subclasses would be garbage collected
+    manifest_tool_classes = []
 
     def __init__(self):
-        self.repo = GitHubRepo('gohugoio', 'hugo')
+        project, repository = self.manifest['repo'].split('/')
+        self.repo = GitHubRepo(project, repository)
         self.release = GitHubRelease(self.repo, 'latest',
-            version_number_accessor=GitHubRelease.version_number_accessor_for_server_data_item_regex('name', self.version_regex()),
-            preferred_asset_predicate=GitHubReleaseAsset.predicate_for_name_regex(r'hugo_extended.*_darwin-universal'))
+            version_number_accessor=GitHubRelease.version_number_accessor_for_server_data_item_regex(self.manifest.get('version_key', 'tag_name'), self.manifest.get('version_regex', self.version_regex())),
+            preferred_asset_predicate=GitHubReleaseAsset.predicate_for_name_regex(self.manifest['asset_regex']))
 
-    def installed_version(self):
-        return self.version_from_process_output(['hugo', 'version'], self.version_regex())
-    
-    def install_archive(self, archive_path):
-        archive = tarfile.open(archive_path)
-        members = [m for m in archive.getmembers() if m.name == 'hugo']
-        archive.extractall(path=os.path.expanduser('~/Documents/websites/hugo/'), members=members)
+    @classmethod
+    def identifier(cls):
+        if cls.manifest:
+            return cls.manifest['identifier']
+        return super().identifier()
 
+    @classmethod
+    def version_regex(cls):
+        return r'\bv((?:[0-9]|\.)+)\b'
 
-class ToolNinja(GitHubReleaseBasedTool):
+    @classmethod
+    def register_manifest(cls, manifest):
+        # Creates a tool class for each manifest entry
+        for entry in manifest:
+            class_name = 'Tool' + ''.join(part.capitalize() for part in re.split(r'[^A-Za-z0-9]+', entry['identifier']))
+            cls.manifest_tool_classes.append(type(class_name, (cls,), dict(manifest=entry)))
+        Tool.tool_class_map = None
 
-    def __init__(self):
-        self.repo = GitHubRepo('ninja-build', 'ninja')
-        self.release = GitHubRelease(self.repo, 'latest',
-            version_number_accessor=GitHubRelease.version_number_accessor_for_server_data_item_regex('tag_name', self.version_regex()),
-            preferred_asset_predicate=GitHubReleaseAsset.predicate_for_name_regex(r'ninja-mac.zip'))
+    @classmethod
+    def load_releases(cls, tools):
+        # With a GITHUB_TOKEN, the releases of all tools are loaded with one GraphQL query,
+        # otherwise each tool loads its own on first use
+        token = os.environ.get('GITHUB_TOKEN')
+        releases = [tool.release for tool in tools if isinstance(tool, cls) and not tool.release.cached_server_data]
+        if not token or not releases:
+            return
+        try:
+            with Profiler.phase('github (batch)', 'metadata fetch'):
+                GitHubRelease.load_latest_releases(releases, token)
+        except Exception as e:
+            logging.warning('Unable to load releases from {}, loading them one by one: {}'.format(GitHubRelease.graphql_url, e))
 
     def installed_version(self):
-        return self.version_from_process_output(['ninja', '--version'], r'\b((?:[0-9]|\.)+)\b')
-    
-    def install_archive(self, archive_path):
-        archive = zipfile.ZipFile(archive_path)
-        archive.extractall(path=os.path.expanduser('~/bin/'), members=['ninja'])
-        os.chmod(os.path.expanduser('~/bin/ninja'), 0o755)
+        return self.version_from_process_output(self.manifest['version_command'], self.manifest.get('installed_version_regex', self.version_regex()))
 
+    def latest_version(self):
+        return self.release.version()
 
-class ToolCmake(GitHubReleaseBasedTool):
+    def latest_version_archive_url(self):
+        return self.release.preferred_asset().download_url()
 
-    def __init__(self):
-        self.repo = GitHubRepo('Kitware', 'CMake')
-        self.release = GitHubRelease(self.repo, 'latest',
-            version_number_accessor=GitHubRelease.version_number_accessor_for_server_data_item_regex('tag_name', self.version_regex()),
-            preferred_asset_predicate=GitHubReleaseAsset.predicate_for_name_regex(r'cmake-\d+\.\d+.\d+-Darwin-x86_64.tar.gz'))
+    def latest_version_archive_checksum(self):
+        return self.release.checksum_for_asset(self.release.preferred_asset())
 
-    def installed_version(self):
-        return self.version_from_process_output(['cmake', '--version'], r'cmake version ((?:[0-9]|\.)+)')
-    
     def install_archive(self, archive_path):
-        archive = tarfile.open(archive_path)
+        # The manifest's install recipe names one of the install_* methods below and supplies its arguments
+        arguments = dict(self.manifest['install'])
+        recipe = arguments.pop('recipe')
+        getattr(self, 'install_' + recipe)(archive_path, **arguments)
+
+    def install_members(self, archive_path, destination, members, mode=None):
+        destination = os.path.expanduser(destination)
+        for member in self.extract_archive(archive_path, destination, members=members):
+            if mode:
+                os.chmod(os.path.join(destination, member), mode)
+
+    def install_app(self, archive_path, app_glob, target_app_path):
         staging_dir_path = self.empty_install_staging_dir_path()
-        archive.extractall(path=staging_dir_path)
-        app_paths = glob.glob(staging_dir_path + '/cmake-*Darwin*/CMake.app')
+        self.extract_archive(archive_path, staging_dir_path)
+        app_paths = glob.glob(os.path.join(staging_dir_path, app_glob))
         assert len(app_paths) == 1, 'Unable to find app paths in "{}"'.format(staging_dir_path)
         app_path = app_paths[0]
-        target_app_path = '/Applications/CMake.app'
         if os.path.exists(target_app_path):
             shutil.rmtree(target_app_path)
         shutil.move(app_path, target_app_path)
 
-
-class ToolCcache(GitHubReleaseBasedTool):
-
-    def __init__(self):
-        self.repo = GitHubRepo('ccache', 'ccache')
-        self.release = GitHubRelease(self.repo, 'latest',
-            version_number_accessor=GitHubRelease.version_number_accessor_for_server_data_item_regex('tag_name', self.version_regex()),
-            preferred_asset_predicate=GitHubReleaseAsset.predicate_for_name_regex(r'ccache-(\d+|\.)+\d+\.tar\.gz$'))
-            
-    def installed_version(self):
-        return self.version_from_process_output(['ccache', '--version'], r'ccache version ((?:[0-9]|\.)+)')
-    
-    def install_archive(self, archive_path):
-        archive = tarfile.open(archive_path)
+    def install_source_build(self, archive_path, configure_arguments=None):
         staging_dir_path = self.empty_install_staging_dir_path()
-        archive.extractall(path=staging_dir_path)
+        members = self.extract_archive(archive_path, staging_dir_path)
         print(staging_dir_path)
 
-        members = [ti.name for ti in archive.getmembers()]
-        toplevel_dir = members[0]
-        source_path = os.path.join(staging_dir_path, toplevel_dir)
-        with self.chdir_to_path(source_path):
-            subprocess.check_call(['./configure'])
-            subprocess.check_call(['sudo', 'make', 'install'])
+        toplevel_dir = members[0].split('/')[0]
+        self.build_from_source(os.path.join(staging_dir_path, toplevel_dir), configure_arguments)
+
+
+# Tools installed from GitHub releases. version_key names the release field that
+# version_regex extracts the version from. version_command and installed_version_regex
+# find the installed version. install names an install_* recipe of GitHubReleaseBasedTool
+# and its arguments. Additional entries in the same format can be loaded with --manifest.
+GITHUB_TOOL_MANIFEST = [
+    dict(identifier='hugo', repo='gohugoio/hugo', asset_regex=r'hugo_extended.*_darwin-universal', version_key='name',
+        version_command=['hugo', 'version'],
+        install=dict(recipe='members', destination='~/Documents/websites/hugo/', members=['hugo'])),
+    dict(identifier='ninja', repo='ninja-build/ninja', asset_regex=r'ninja-mac.zip',
+        version_command=['ninja', '--version'], installed_version_regex=r'\b((?:[0-9]|\.)+)\b',
+        install=dict(recipe='members', destination='~/bin/', members=['ninja'], mode=0o755)),
+    dict(identifier='cmake', repo='Kitware/CMake', asset_regex=r'cmake-\d+\.\d+.\d+-Darwin-x86_64.tar.gz',
+        version_command=['cmake', '--version'], installed_version_regex=r'cmake version ((?:[0-9]|\.)+)',
+        install=dict(recipe='app', app_glob='cmake-*Darwin*/CMake.app', target_app_path='/Applications/CMake.app')),
+    dict(identifier='ccache', repo='ccache/ccache', asset_regex=r'ccache-(\d+|\.)+\d+\.tar\.gz$',
+        version_command=['ccache', '--version'], installed_version_regex=r'ccache version ((?:[0-9]|\.)+)',
+        install=dict(recipe='source_build')),
+]
+GitHubReleaseBasedTool.register_manifest(GITHUB_TOOL_MANIFEST)
 
 
 class ToolExifTool(Tool):
@@ -342,15 +840,13 @@ class ToolExifTool(Tool):
     def server_data(self):
         if not self.cached_server_data:
             try:
-                request = urllib.request.Request(self.info_page_url)
-                response = urllib.request.urlopen(request)
-                data = response.read()
+                data = HTTPClient.fetch(self.info_page_url).decode('utf-8')
                 results = re.findall(r'<a href="(ExifTool-([\d+.]+).dmg)">', data)
                 if results:
                     self.cached_server_data = results[0]
                 else:
                     print(data, file=sys.stderr)
-                    print('Unable to find DMG link in page content of {}'.format(info_page_url), file=sys.stderr)
+                    print('Unable to find DMG link in page content of {}'.format(self.info_page_url), file=sys.stderr)
             except Exception as e:
                 print('Unable to open URL {}: {}'.format(self.info_page_url, e), file=sys.stderr)
         return self.cached_server_data
@@ -377,11 +873,33 @@ class ToolExifTool(Tool):
 
 class PKGBasedTool(Tool):
 
+    def __init__(self):
+        # Creating a tool stays local, the download page is only loaded once the latest version is needed
+        self.cached_server_data = None
+
+    def server_data(self):
+        if not self.cached_server_data:
+            try:
+                self.cached_server_data = self.load_server_data()
+            except Exception as e:
+                print('Unable to load latest version information for {}: {}'.format(self.identifier(), e), file=sys.stderr)
+        return self.cached_server_data
+
+    def load_server_data(self):
+        # Returns an (archive URL, version string) tuple
+        raise Exception('"{}" must override this method'.format(type(self).__name__))
+
     def latest_version(self):
-        return pkg_resources.parse_version(self.server_version)
+        data = self.server_data()
+        if not data:
+            return None
+        return pkg_resources.parse_version(data[1])
     
     def latest_version_archive_url(self):
-        return self.archive_url
+        data = self.server_data()
+        if not data:
+            return None
+        return data[0]
 
     def install_archive(self, archive_path):
         cmd = ['sudo', 'installer', '-pkg', archive_path, '-target', '/']
@@ -390,16 +908,14 @@ class PKGBasedTool(Tool):
 
 class ToolPython3(PKGBasedTool):
 
-    def __init__(self):
+    def load_server_data(self):
         download_page_url = 'https://www.python.org/downloads/'
-        request = urllib.request.Request(download_page_url)
-        response = urllib.request.urlopen(request)
-        self.data = response.read().decode('utf-8')
-        result = re.findall(r'href="(.*/python-([\d+.]+).*pkg)">Download Python 3', self.data)
+        data = HTTPClient.fetch(download_page_url).decode('utf-8')
+        result = re.findall(r'href="(.*/python-([\d+.]+).*pkg)">Download Python 3', data)
         if not result:
-            print(self.data)
-            raise('Unable to find pkg link in page content of {}'.format(download_page_url))
-        self.archive_url, self.server_version = result[0]
+            logging.debug(data)
+            raise Exception('Unable to find pkg link in page content of {}'.format(download_page_url))
+        return result[0]
     
     def installed_version(self):
         return self.version_from_process_output(['python3', '-V'], r'\b([0-9.]+)\b')
@@ -407,18 +923,15 @@ class ToolPython3(PKGBasedTool):
 
 class ToolNode(PKGBasedTool):
 
-    def __init__(self):
+    def load_server_data(self):
         download_page_url = 'https://nodejs.org/en/'
-        request = urllib.request.Request(download_page_url)
-        logging.debug('Loading {}'.format(download_page_url))
-        response = urllib.request.urlopen(request)
-        self.data = response.read().decode('utf-8')
-        result = re.findall(r'<a href="(https://nodejs\.org/dist/v.*?/)".*?title="Download .*?Current".*?data-version="v([0-9\.]+)', self.data)
+        data = HTTPClient.fetch(download_page_url).decode('utf-8')
+        result = re.findall(r'<a href="(https://nodejs\.org/dist/v.*?/)".*?title="Download .*?Current".*?data-version="v([0-9\.]+)', data)
         if not result:
-            print(self.data)
+            logging.debug(data)
             raise Exception('Unable to find pkg link in page content of {}'.format(download_page_url))
-        self.archive_url, self.server_version = result[0]
-        self.archive_url += 'node-v{}.pkg'.format(self.server_version)
+        archive_url, server_version = result[0]
+        return archive_url + 'node-v{}.pkg'.format(server_version), server_version
     
     def installed_version(self):
         return self.version_from_process_output(['node', '--version'], r'v([0-9.]+)\b')
@@ -446,14 +959,52 @@ class AbstractSubcommand(object):
         else:
             return Tool.known_identifiers()
 
-    def enumerate_selected_or_installed_tools(self):
-        if self.args.tool_identifier:
-            for i in self.args.tool_identifier:
-                tool = Tool.tool_for_identifier(i)
-                yield i, tool
-        else:
-            for tool in Tool.enumerate_installed_tools():
-                yield tool
+    def tools_with_versions(self, identifiers_and_tools, installed_only=False):
+        # Checks installed and latest versions of all tools concurrently, the wall time is that
+        # of the slowest check. Results are returned in the order of the input. With installed_only,
+        # the latest version is only looked up for tools that turn out to be installed.
+        identifiers_and_tools = list(identifiers_and_tools)
+        Profiler.tool_order = [identifier for identifier, tool in identifiers_and_tools]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.args.jobs) as executor:
+            installed_versions = [executor.submit(Profiler.timed, identifier, 'version probe', tool.installed_version) for identifier, tool in identifiers_and_tools]
+            # Runs while the installed versions are probed
+            GitHubReleaseBasedTool.load_releases([tool for identifier, tool in identifiers_and_tools])
+            if installed_only:
+                # Probes were queued first, so a worker waiting here never holds up the probe it waits for
+                latest_versions = [executor.submit(self.latest_version_if_installed, identifier, tool, installed_version) for (identifier, tool), installed_version in zip(identifiers_and_tools, installed_versions)]
+            else:
+                latest_versions = [executor.submit(Profiler.timed, identifier, 'metadata fetch', tool.latest_version) for identifier, tool in identifiers_and_tools]
+            return [(identifier, tool, (installed_version.result(), latest_version.result())) for (identifier, tool), installed_version, latest_version in zip(identifiers_and_tools, installed_versions, latest_versions)]
+
+    @classmethod
+    def latest_version_if_installed(cls, identifier, tool, installed_version):
+        if installed_version.result() is None:
+            return None
+        return Profiler.timed(identifier, 'metadata fetch', tool.latest_version)
+
+    def install_tools(self, tools):
+        # Downloads run concurrently, installs run one at a time in the given order
+        # as soon as the tool's download is complete. Streamed installs download while
+        # they install and are not started ahead.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.args.jobs) as executor:
+            downloads = {tool: executor.submit(tool.download_latest_version) for tool in tools if not self.streams_install(tool)}
+            for tool in tools:
+                if tool not in downloads:
+                    tool.stream_latest_version()
+                    continue
+                try:
+                    archive_path = downloads[tool].result()
+                except Exception as e:
+                    print('Unable to download {}: {}'.format(tool.identifier(), e), file=sys.stderr)
+                    continue
+                if archive_path:
+                    tool.install_latest_version(archive_path)
+
+    def streams_install(self, tool):
+        return self.args.stream and tool.supports_streamed_install
+
+    def selected_or_all_tools(self):
+        return [(identifier, Tool.tool_for_identifier(identifier)) for identifier in self.selected_or_all_tool_identifiers()]
 
 
 class SubcommandStatus(AbstractSubcommand):
@@ -462,10 +1013,7 @@ class SubcommandStatus(AbstractSubcommand):
     """
     
     def run(self):
-        for identifier in self.selected_or_all_tool_identifiers():
-            tool = Tool.tool_for_identifier(identifier)
-            v1 = tool.installed_version()
-            v2 = tool.latest_version()
+        for identifier, tool, (v1, v2) in self.tools_with_versions(self.selected_or_all_tools()):
             if v1 == v2:
                 color = '\033[0;32m'
             else:
@@ -483,19 +1031,23 @@ class SubcommandInstall(AbstractSubcommand):
     """
     
     def run(self):
-        for identifier in self.selected_or_all_tool_identifiers():
-            logging.debug('Searching for tool with identifier {}'.format(identifier))
-            tool = Tool.tool_for_identifier(identifier)
-            logging.debug('Installed version: {}, current version: {}'.format(tool.installed_version(), tool.latest_version()))            
-            if tool.is_installed() and not tool.is_out_of_date() and not self.args.force:
-                print('{} is current at version {}'.format(identifier, tool.installed_version()))
+        tools = []
+        for identifier, tool, versions in self.tools_with_versions(self.selected_or_all_tools()):
+            installed_version, latest_version = versions
+            logging.debug('Installed version: {}, current version: {}'.format(installed_version, latest_version))
+            if installed_version is not None and not tool.is_out_of_date(versions) and not self.args.force:
+                print('{} is current at version {}'.format(identifier, installed_version))
                 continue
-            tool.install_latest_version()
+            tools.append(tool)
+        self.install_tools(tools)
 
     @classmethod
     def configure_argument_parser(cls, parser):
         parser.add_argument('tool_identifier', nargs='*', help='Identifier of the tool to update. Optional, defaults to all known tools.')
         parser.add_argument('-f', '--force', action='store_true', help='Force update even if the installed version is up to date')
+        parser.add_argument('--stream', action='store_true', help='Extract tar and zip archives directly from the download, without the download cache and checksum verification')
+        parser.add_argument('--build-jobs', type=int, default=Tool.build_jobs, help='Number of parallel jobs for tools built from source, default {}'.format(Tool.build_jobs))
+        parser.add_argument('--ccache', action='store_true', help='Compile tools built from source through ccache if it is installed')
 
 
 class SubcommandUpdate(AbstractSubcommand):
@@ -504,16 +1056,25 @@ class SubcommandUpdate(AbstractSubcommand):
     """
     
     def run(self):
-        for identifier, tool in self.enumerate_selected_or_installed_tools():
-            logging.debug('Installed version: {}, current version: {}'.format(tool.installed_version(), tool.latest_version()))
-            if not tool.is_out_of_date() and not self.args.force:
+        tools = []
+        # Without identifiers, all known tools are probed on the pool and the ones that aren't installed are skipped
+        installed_only = not self.args.tool_identifier
+        for identifier, tool, versions in self.tools_with_versions(self.selected_or_all_tools(), installed_only):
+            if installed_only and versions[0] is None:
                 continue
-            tool.install_latest_version()
+            logging.debug('Installed version: {}, current version: {}'.format(*versions))
+            if not tool.is_out_of_date(versions) and not self.args.force:
+                continue
+            tools.append(tool)
+        self.install_tools(tools)
 
     @classmethod
     def configure_argument_parser(cls, parser):
         parser.add_argument('tool_identifier', nargs='*', help='Identifier of the tool to update. Optional, defaults to all installed tools.')
         parser.add_argument('-f', '--force', action='store_true', help='Force update even if the installed version is up to date')
+        parser.add_argument('--stream', action='store_true', help='Extract tar and zip archives directly from the download, without the download cache and checksum verification')
+        parser.add_argument('--build-jobs', type=int, default=Tool.build_jobs, help='Number of parallel jobs for tools built from source, default {}'.format(Tool.build_jobs))
+        parser.add_argument('--ccache', action='store_true', help='Compile tools built from source through ccache if it is installed')
 
 
 class CommandLineDriver(object):
@@ -528,6 +1089,13 @@ class CommandLineDriver(object):
     def run(self):
         parser = argparse.ArgumentParser(description='Manage some external tools not supplied with the OS')
         parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose debug logging')
+        parser.add_argument('-j', '--jobs', type=int, default=8, help='Number of version checks to run concurrently, default 8')
+        parser.add_argument('--cache-ttl', type=float, default=600, help='Seconds to use cached server responses without revalidating them, default 600. Stale responses are used when a server is unreachable.')
+        parser.add_argument('--no-cache', dest='use_cache', action='store_false', help='Do not use the persistent cache of server responses in {}'.format(HTTPCache.default_path()))
+        parser.add_argument('--manifest', action='append', default=[], help='JSON file with a list of additional GitHub release based tools, in the format of GITHUB_TOOL_MANIFEST. Can be given more than once.')
+        parser.add_argument('--profile', action='store_true', help='Print how long each phase (version probe, metadata fetch, download, extract, install) took per tool')
+        parser.add_argument('--profile-trace', metavar='PATH', help='Write the phase timings to PATH as a Chrome trace event JSON file')
+        parser.add_argument('--timeout', type=float, default=HTTPClient.timeout, help='Seconds to wait for each server request and version probe, default {}'.format(HTTPClient.timeout))
         subparsers = parser.add_subparsers(title='Subcommands', dest='subcommand_name')
 
         subcommand_map = self.subcommand_map()
@@ -538,9 +1106,27 @@ class CommandLineDriver(object):
         args = parser.parse_args()
         if args.verbose:
             logging.basicConfig(level=logging.DEBUG)
+        HTTPClient.timeout = args.timeout
+        for manifest_path in args.manifest:
+            with open(manifest_path) as f:
+                GitHubReleaseBasedTool.register_manifest(json.load(f))
+        if 'build_jobs' in args:
+            Tool.build_jobs = args.build_jobs
+            Tool.use_ccache = args.ccache
+        if args.use_cache:
+            HTTPClient.cache = HTTPCache(ttl=args.cache_ttl)
+        Tool.process_timeout = args.timeout
+
+        Profiler.enabled = args.profile or bool(args.profile_trace)
 
         subcommand_class = subcommand_map[args.subcommand_name]
-        subcommand_class(args).run()
+        try:
+            subcommand_class(args).run()
+        finally:
+            if args.profile:
+                Profiler.print_report()
+            if args.profile_trace:
+                Profiler.write_trace(args.profile_trace)
 
 
 if __name__ == "__main__":